@@ -0,0 +1,209 @@
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from rich.console import Console
+from rich.logging import RichHandler
+from rich.table import Table
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "trading212-pie-sync"))
+
+from driver import ChromeDriver, wait_for
+from navigator import Navigator
+from planner import plan_sync
+from timings import tracer
+
+from standin.server import serve
+
+log = logging.getLogger("trading-212-sync")
+
+
+class PhaseTimer:
+    def __init__(self, size, mode, driver):
+        self.size = size
+        self.mode = mode
+        self.driver = driver
+        self.results = []
+        # the highest memory used by the browser at the end of a phase, in bytes
+        self.peak_rss = 0
+
+    @contextmanager
+    def phase(self, name):
+        commands = sum(tracer.commands.values())
+        started = time.perf_counter()
+        with tracer.span(f"{self.size}: {name}", "phase"):
+            yield
+        self.peak_rss = max(self.peak_rss, self.driver.memory_usage() or 0)
+        self.results.append(
+            {
+                "size": self.size,
+                "mode": self.mode,
+                "phase": name,
+                "seconds": round(time.perf_counter() - started, 3),
+                "commands": sum(tracer.commands.values()) - commands,
+            }
+        )
+
+
+def benchmark(server, size, headless=True, capture_network=False, lean=False):
+    # syncs a pie of the given size with the stand-in's shared pie, which removes,
+    # adds and rebalances instruments, timing each phase of the process. Returns
+    # the results of each phase, and a summary of the run
+    server.state.reset(size)
+    mode = "lean" if lean else "full"
+    with tempfile.TemporaryDirectory() as profile:
+        driver = ChromeDriver(
+            headless=headless,
+            profile=profile,
+            capture_network=capture_network,
+            lean=lean,
+        )
+        try:
+            n = Navigator(driver, base_url=server.url)
+            timer = PhaseTimer(size, mode, driver)
+            with timer.phase("shared pie"):
+                data = n.parse_shared_pie(f"{server.url}/pies/bench")
+            with timer.phase("login"):
+                n.open_dashboard("bench@example.com", "password")
+                page_load = driver.page_load_time()
+            with timer.phase("select pie"):
+                n.select_pie("Bench")
+            with timer.phase("plan"):
+                plan = plan_sync(n.get_current_instruments(), data)
+            with timer.phase("remove"):
+                for removal in plan.removals:
+                    n.remove_instrument(removal.ticker)
+            with timer.phase("lookup"):
+                n.lookup_instruments([a.ticker for a in plan.additions])
+            with timer.phase("add"):
+                added = n.add_instruments([a.ticker for a in plan.additions])
+            with timer.phase("rebalance"):
+                targets = {r.ticker: r.target for r in plan.rebalances}
+                targets.update({added[a.ticker]: a.target for a in plan.additions})
+                n.apply_weights(targets)
+                n.redistribute_pie()
+            with timer.phase("commit"):
+                n.commit_pie_edits(name="Bench")
+                # the stand-in goes back to the pie details once changes are saved
+                wait_for(driver, ".bucket-details")
+        finally:
+            driver.quit()
+
+    synced = server.state.pies["Bench"]
+    if set(synced) != set(data):
+        log.error(f"Pie of size {size} didn't sync correctly: {sorted(synced)}")
+    run = {
+        "size": size,
+        "mode": mode,
+        "seconds": round(sum(result["seconds"] for result in timer.results), 3),
+        "page_load": round(page_load, 3) if page_load is not None else None,
+        "peak_rss": timer.peak_rss,
+    }
+    return timer.results, run
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Benchmark the pie sync process against a local Trading212 stand-in"
+    )
+    argparser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[5, 25, 50],
+        help="The amount of instruments in the benchmarked pies",
+    )
+    argparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="The simulated latency of the stand-in, in seconds",
+    )
+    argparser.add_argument(
+        "--no-headless", action="store_true", help="Show the browser window"
+    )
+    argparser.add_argument(
+        "--capture-network",
+        action="store_true",
+        help="Read the stand-in data from the network responses rather than the page",
+    )
+    argparser.add_argument(
+        "--lean",
+        choices=["off", "on", "both"],
+        default="off",
+        help="Run the browser in lean mode, or run every size both with and "
+        "without it to compare them",
+    )
+    argparser.add_argument(
+        "--trace",
+        help="Export the timings of every step to this .json file, in the chrome "
+        "trace event format",
+    )
+    argparser.add_argument(
+        "--output",
+        type=argparse.FileType("w"),
+        help="Save the benchmark results to this .json file",
+    )
+    args = argparser.parse_args()
+
+    log.setLevel(logging.WARNING)
+    log.addHandler(RichHandler())
+    log.propagate = False
+
+    # the tracer counts the WebDriver commands of each phase
+    tracer.enable(export_path=args.trace)
+    server = serve(latency=args.latency)
+    modes = {"off": [False], "on": [True], "both": [False, True]}[args.lean]
+    results = []
+    runs = []
+    for size in args.sizes:
+        for lean in modes:
+            phases, run = benchmark(
+                server,
+                size,
+                headless=not args.no_headless,
+                capture_network=args.capture_network,
+                lean=lean,
+            )
+            results += phases
+            runs.append(run)
+    server.shutdown()
+
+    table = Table(title=f"Sync benchmark (latency {args.latency}s)")
+    for column in ("Size", "Mode", "Phase", "Time", "Commands"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            str(result["size"]),
+            result["mode"],
+            result["phase"],
+            f"{result['seconds']:.3f}s",
+            str(result["commands"]),
+        )
+    Console().print(table)
+
+    table = Table(title="Browser runs")
+    for column in ("Size", "Mode", "Total time", "Page load", "Peak memory"):
+        table.add_column(column)
+    for run in runs:
+        table.add_row(
+            str(run["size"]),
+            run["mode"],
+            f"{run['seconds']:.3f}s",
+            f"{run['page_load']:.3f}s" if run["page_load"] is not None else "-",
+            f"{run['peak_rss'] / (1 << 20):.0f} MB" if run["peak_rss"] else "-",
+        )
+    Console().print(table)
+    if args.output:
+        json.dump({"phases": results, "runs": runs}, args.output, indent=2)
+    if args.trace:
+        tracer.export(args.trace)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+log = logging.getLogger("trading-212-sync.standin")
+
+SITE = Path(__file__).parent / "site"
+
+
+def generate_instruments(count=500, seed=212):
+    # a deterministic universe of fake instruments to search and add to pies
+    rng = random.Random(seed)
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    instruments = {}
+    while len(instruments) < count:
+        ticker = "".join(rng.choice(letters) for _ in range(rng.randint(2, 4)))
+        instruments[ticker] = {
+            "code": f"{ticker}_US_EQ",
+            "ticker": ticker,
+            "name": f"{ticker.title()} Corporation",
+        }
+    return list(instruments.values())
+
+
+def equal_weights(tickers):
+    # splits 100% across the tickers in 0.1 steps, the remainder going to the first
+    if not tickers:
+        return {}
+    share = int(1000 / len(tickers))
+    weights = {ticker: share / 10 for ticker in tickers}
+    remainder = (1000 - share * len(tickers)) / 10
+    weights[tickers[0]] = round(weights[tickers[0]] + remainder, 1)
+    return weights
+
+
+class StandinState:
+    # The server side data of the stand-in: the instruments universe, the user's
+    # pies and the shared pies, all kept in memory
+    def __init__(self, pie_size=25, instruments=500):
+        self.lock = threading.Lock()
+        self.instruments = generate_instruments(instruments)
+        self.reset(pie_size)
+
+    def reset(self, pie_size=25, pie_name="Bench"):
+        with self.lock:
+            tickers = [instrument["ticker"] for instrument in self.instruments]
+            self.pies = {pie_name: equal_weights(tickers[:pie_size])}
+            # the shared pie overlaps the user's pie, so syncing one with the other
+            # involves removals, additions and rebalances
+            shared = tickers[pie_size // 5 : pie_size + pie_size // 5]
+            self.shared_pies = {
+                "bench": {"name": "Shared bench", "holdings": equal_weights(shared)}
+            }
+
+    def search(self, query):
+        # matches a "(TICKER)" query exactly, like the instrument search does,
+        # and anything else as a case insensitive substring of ticker or name
+        query = query.strip()
+        if query.startswith("(") and query.endswith(")"):
+            ticker = query[1:-1].upper()
+            return [i for i in self.instruments if i["ticker"] == ticker]
+        query = query.lower()
+        return [
+            i
+            for i in self.instruments
+            if query and (query in i["ticker"].lower() or query in i["name"].lower())
+        ][:20]
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state, latency=0.0):
+        super().__init__(address, StandinHandler)
+        self.state = state
+        # simulated latency of every API response and UI transition, in seconds
+        self.latency = latency
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def send(self, status, body, content_type="text/html; charset=utf-8"):
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, body, status=200):
+        self.send(status, json.dumps(body), "application/json")
+
+    def send_page(self, name):
+        # serve one of the html fixtures, telling its scripts the simulated latency
+        html = (SITE / name).read_text()
+        config = json.dumps({"latency": self.server.latency * 1000})
+        html = html.replace("/* standin-config */", f"window.STANDIN = {config};")
+        self.send(200, html)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        state = self.server.state
+        if path.startswith("/api/"):
+            time.sleep(self.server.latency)
+        if path in ("/en/login", "/login"):
+            return self.send_page("login.html")
+        if path in ("/", "/beta", "/app"):
+            return self.send_page("app.html")
+        if path.startswith("/pies/"):
+            return self.send_page("shared-pie.html")
+        if path == "/standin.js":
+            return self.send(
+                200, (SITE / "standin.js").read_text(), "application/javascript"
+            )
+        if path == "/en/Trade-Equities":
+            rows = "".join(
+                f"<tr><td data-label='Instrument'>{escape(i['ticker'])}</td>"
+                f"<td data-label='Company'>{escape(i['name'])}</td></tr>"
+                for i in state.instruments
+            )
+            return self.send(
+                200, f"<html><body><table id='all-equities'>{rows}</table></body></html>"
+            )
+        if path == "/api/pies":
+            with state.lock:
+                return self.send_json(
+                    [{"name": name, "holdings": h} for name, h in state.pies.items()]
+                )
+        if path.startswith("/api/shared-pies/"):
+            shared = state.shared_pies.get(path.rsplit("/", 1)[1])
+            if shared is None:
+                return self.send_json({"error": "Not found"}, 404)
+            return self.send_json(shared)
+        if path == "/api/instruments/search":
+            query = parse_qs(urlparse(self.path).query).get("query", [""])[0]
+            return self.send_json(state.search(query))
+        if path == "/api/instruments":
+            return self.send_json(state.instruments)
+        self.send(404, "Not found")
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        state = self.server.state
+        time.sleep(self.server.latency)
+        if path == "/api/login":
+            # any credentials will do, the session cookie is never checked
+            self.read_json()
+            payload = b'{"ok": true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.send_header("Set-Cookie", "session=standin; Path=/")
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if path == "/api/pies":
+            # creates or replaces a pie with the given holdings
+            pie = self.read_json()
+            with state.lock:
+                state.pies[pie["name"]] = pie["holdings"]
+            return self.send_json(pie)
+        if path == "/api/reset":
+            body = self.read_json()
+            state.reset(body.get("size", 25), body.get("name", "Bench"))
+            return self.send_json({"ok": True})
+        self.send(404, "Not found")
+
+
+def serve(host="127.0.0.1", port=0, pie_size=25, latency=0.0, instruments=500):
+    # starts the stand-in on a background thread, returning the server
+    server = StandinServer(
+        (host, port), StandinState(pie_size, instruments), latency=latency
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="A local stand-in for the Trading212 website pages used by the tool"
+    )
+    argparser.add_argument("--port", type=int, default=8213)
+    argparser.add_argument("--pie-size", type=int, default=25)
+    argparser.add_argument(
+        "--latency", type=float, default=0.0, help="Simulated latency, in seconds"
+    )
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = StandinServer(
+        ("127.0.0.1", args.port), StandinState(args.pie_size), latency=args.latency
+    )
+    log.info(f"Stand-in listening on {server.url}")
+    server.serve_forever()
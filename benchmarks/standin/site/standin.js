@@ -0,0 +1,343 @@
+// A minimal stand-in for the Trading212 invest platform, reproducing the markup
+// and selectors the tool relies on. Every transition is delayed by the simulated
+// latency, and the data is loaded from (and saved to) the stand-in's JSON api.
+const latency = (window.STANDIN && window.STANDIN.latency) || 0;
+const later = (callback) => setTimeout(callback, latency);
+const $ = (selector, root = document) => root.querySelector(selector);
+const html = (markup) => {
+  const template = document.createElement("template");
+  template.innerHTML = markup.trim();
+  return template.content.firstChild;
+};
+const round = (value) => Math.round(value * 10) / 10;
+
+let pies = {};
+
+const api = {
+  pies: () => fetch("/api/pies").then((response) => response.json()),
+  save: (name, holdings) =>
+    fetch("/api/pies", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ name, holdings }),
+    }),
+  search: (query) =>
+    fetch(`/api/instruments/search?query=${encodeURIComponent(query)}`).then(
+      (response) => response.json()
+    ),
+};
+
+// --- portfolio and pies list ---
+
+function loadPies() {
+  return api.pies().then((list) => {
+    pies = {};
+    for (const pie of list) pies[pie.name] = pie.holdings;
+  });
+}
+
+function showPortfolio() {
+  later(() => {
+    $("#content").innerHTML = `
+      <div class="portfolio-section">
+        <div class="investments-section">
+          <div data-qa-tab="investments">Investments</div>
+          <div data-qa-tab="buckets">Pies</div>
+          <div class="investments-tab-content"></div>
+        </div>
+      </div>`;
+    $(".investments-section div[data-qa-tab=buckets]").onclick = showPies;
+  });
+}
+
+function showPies() {
+  loadPies().then(() =>
+    later(() => {
+      const items = Object.keys(pies)
+        .map((name) => `<div class="bucket-item" data-qa-item="${name}">${name}</div>`)
+        .join("");
+      const tab = $(".investments-tab-content");
+      tab.innerHTML = `
+        <div class="buckets-list">
+          ${items}
+          <div class="bucket-creation-button">Create pie</div>
+        </div>`;
+      for (const item of tab.querySelectorAll(".bucket-item")) {
+        item.onclick = () => showPie(item.dataset.qaItem);
+      }
+      $(".bucket-creation-button", tab).onclick = showPieCreation;
+    })
+  );
+}
+
+function showPie(name) {
+  later(() => {
+    $("#content").innerHTML = `
+      <div class="bucket-details" data-qa-bucket="${name}">
+        <h2>${name}</h2>
+        <div class="bucket-advanced-tabs">
+          <div class="bucket-advanced-tab" data-qa-tab="overview">Overview</div>
+          <div class="bucket-advanced-tab" data-qa-tab="holdings">Holdings</div>
+        </div>
+        <div class="bucket-holdings"></div>
+        <div class="edit-bucket-button">Edit pie</div>
+      </div>`;
+    $(".bucket-advanced-tab[data-qa-tab=holdings]").onclick = () => showHoldings(name);
+    $(".edit-bucket-button").onclick = () => later(() => openEditor(name, pies[name]));
+  });
+}
+
+function showHoldings(name) {
+  later(() => {
+    const entries = Object.entries(pies[name]);
+    if (!entries.length) {
+      $(".bucket-holdings").innerHTML =
+        '<div class="bucket-holdings-empty">This pie has no holdings</div>';
+      return;
+    }
+    $(".bucket-holdings").innerHTML = entries
+      .map(
+        ([ticker, target]) => `
+        <div class="bucket-holding" data-qa-ticker="${ticker}">
+          <div class="instrument-logo-name">${ticker}</div>
+          <div class="bucket-holding-target">${target}%</div>
+        </div>`
+      )
+      .join("");
+  });
+}
+
+function showPieCreation() {
+  later(() => {
+    $("#content").innerHTML = `
+      <div class="bucket-creation">
+        <div class="add-instruments"><div class="button">Add instruments</div></div>
+      </div>`;
+    $(".bucket-creation .add-instruments .button").onclick = () =>
+      later(() => {
+        $(".bucket-creation").innerHTML = "";
+        openEditor(null, {}, $(".bucket-creation"));
+        openAddSlices();
+      });
+  });
+}
+
+// --- pie editor ---
+
+let editor = null;
+
+function openEditor(name, holdings, container = $("#content")) {
+  const creating = name === null;
+  const root = html(`
+    <div class="bucket-customisation">
+      ${creating ? '<div class="bucket-personalisation"><input placeholder="Pie name" /></div>' : ""}
+      <div class="bucket-instruments-personalisation-header"></div>
+      <div class="bucket-instruments-personalisation"></div>
+      <div class="${creating ? "bucket-creation-footer" : "bucket-customisation-footer"}">
+        <div class="slices-distribution-indicator"></div>
+        <div class="button add-slice-button">Add slice</div>
+        <div class="button complete-button">${creating ? "Next" : "Done"}</div>
+      </div>
+    </div>`);
+  container.appendChild(root);
+  editor = { name, creating, root, slices: new Map() };
+  for (const [ticker, weight] of Object.entries(holdings)) addSlice(ticker, weight);
+  $(".add-slice-button", root).onclick = () => later(openAddSlices);
+  $(".complete-button", root).onclick = creating ? completeCreation : completeEdit;
+  refreshTotals();
+}
+
+function addSlice(ticker, weight) {
+  // slices elements are created once and updated in place, like a real
+  // framework would, so element handles held by the tool stay valid
+  const element = html(`
+    <div class="bucket-instrument-personalisation">
+      <div class="instrument-logo-name">${ticker}</div>
+      <div class="instrument-share-container">
+        <div class="spinner"><input type="text" value="${weight}" /></div>
+      </div>
+      <div class="lock-unlock-tooltip"><span class="lock-icon">lock</span></div>
+      <div class="close-button">x</div>
+    </div>`);
+  const slice = { ticker, weight, locked: false, element };
+  const field = $(".spinner input", element);
+  const onInput = () => {
+    const value = parseFloat(field.value);
+    slice.weight = isNaN(value) ? 0 : value;
+    setLocked(slice, true);
+    refreshTotals();
+  };
+  field.addEventListener("input", onInput);
+  field.addEventListener("change", onInput);
+  $(".lock-unlock-tooltip", element).onclick = () => setLocked(slice, !slice.locked);
+  $(".close-button", element).onclick = () => confirmRemoval(slice);
+  editor.slices.set(ticker, slice);
+  $(".bucket-instruments-personalisation", editor.root).appendChild(element);
+}
+
+function setLocked(slice, locked) {
+  slice.locked = locked;
+  $(".lock-unlock-tooltip", slice.element).classList.toggle("locked", locked);
+}
+
+function setWeight(slice, weight) {
+  slice.weight = round(weight);
+  $(".spinner input", slice.element).value = slice.weight;
+}
+
+function total() {
+  let sum = 0;
+  for (const slice of editor.slices.values()) sum += slice.weight;
+  return round(sum);
+}
+
+function refreshTotals() {
+  const sum = total();
+  $(".slices-distribution-indicator", editor.root).textContent = `${sum}%`;
+  const header = $(".bucket-instruments-personalisation-header", editor.root);
+  const adjust = $(".adjust-slices-tooltip", header);
+  if (sum !== 100 && editor.slices.size && !adjust) {
+    const button = html('<div class="adjust-slices-tooltip">Adjust to 100%</div>');
+    button.onclick = () => later(redistribute);
+    header.appendChild(button);
+  } else if ((sum === 100 || !editor.slices.size) && adjust) {
+    adjust.remove();
+  }
+}
+
+function redistribute() {
+  // scale the unlocked slices (or all of them, if they are all locked) so the pie
+  // adds up to 100%, and give the rounding remainder to the largest one
+  const slices = [...editor.slices.values()];
+  let adjustable = slices.filter((slice) => !slice.locked);
+  if (!adjustable.length) adjustable = slices;
+  const fixed = total() - adjustable.reduce((sum, slice) => sum + slice.weight, 0);
+  const current = adjustable.reduce((sum, slice) => sum + slice.weight, 0);
+  for (const slice of adjustable) {
+    setWeight(slice, current ? (slice.weight * (100 - fixed)) / current : (100 - fixed) / adjustable.length);
+  }
+  const largest = adjustable.reduce((a, b) => (a.weight >= b.weight ? a : b));
+  setWeight(largest, largest.weight + 100 - total());
+  refreshTotals();
+}
+
+function confirmRemoval(slice) {
+  later(() => {
+    const popup = html(`
+      <div class="popup-content">
+        <div class="dialog">
+          <p>Remove ${slice.ticker}?</p>
+          <div class="confirm-button">Remove</div>
+        </div>
+      </div>`);
+    $("#popups").appendChild(popup);
+    $(".confirm-button", popup).onclick = () =>
+      later(() => {
+        popup.remove();
+        slice.element.remove();
+        editor.slices.delete(slice.ticker);
+        refreshTotals();
+      });
+  });
+}
+
+// --- instruments search popup ---
+
+function openAddSlices() {
+  const popup = html(`
+    <div class="bucket-add-slices">
+      <input class="search-input" placeholder="Search" />
+      <div class="search-results-content"></div>
+      <div class="bucket-add-slices-footer"><div class="button">Add to pie</div></div>
+    </div>`);
+  (editor.creating ? $(".bucket-creation") : $("#popups")).appendChild(popup);
+  const selected = new Map();
+  const results = $(".search-results-content", popup);
+  let searching = null;
+  $(".search-input", popup).addEventListener("input", (event) => {
+    const query = event.target.value;
+    clearTimeout(searching);
+    searching = setTimeout(
+      () =>
+        api.search(query).then((instruments) => {
+          if ($(".search-input", popup).value !== query) return;
+          results.innerHTML = "";
+          for (const instrument of instruments) {
+            const row = html(`
+              <div class="search-results-instrument" data-qa-code="${instrument.code}">
+                <div class="cell-name">${instrument.name}</div>
+                <div class="cell-symbol">${instrument.ticker}</div>
+                <div class="add-to-bucket">+</div>
+              </div>`);
+            const add = $(".add-to-bucket", row);
+            add.classList.toggle("added", selected.has(instrument.code));
+            add.onclick = () => {
+              selected.set(instrument.code, instrument.ticker);
+              add.classList.add("added");
+            };
+            results.appendChild(row);
+          }
+        }),
+      latency
+    );
+  });
+  $(".bucket-add-slices-footer > .button", popup).onclick = () =>
+    later(() => {
+      popup.remove();
+      const added = [...selected.values()].filter((ticker) => !editor.slices.has(ticker));
+      if (!added.length) return;
+      // new slices get an equal share of the pie, like on the real platform
+      const share = round(100 / (editor.slices.size + added.length));
+      for (const slice of editor.slices.values()) setWeight(slice, share);
+      for (const ticker of added) addSlice(ticker, share);
+      refreshTotals();
+    });
+}
+
+// --- committing changes ---
+
+function holdingsOf() {
+  const holdings = {};
+  for (const slice of editor.slices.values()) holdings[slice.ticker] = slice.weight;
+  return holdings;
+}
+
+function completeEdit() {
+  const { name } = editor;
+  api.save(name, holdingsOf()).then(() =>
+    later(() => {
+      pies[name] = holdingsOf();
+      editor = null;
+      showPie(name);
+    })
+  );
+}
+
+function completeCreation() {
+  // creating a pie takes one more step, choosing how to invest in it
+  later(() => {
+    const creation = $(".bucket-creation");
+    const name = $(".bucket-personalisation input", creation).value;
+    const holdings = holdingsOf();
+    creation.innerHTML = `
+      <div class="autoinvest-options">
+        <div data-qa-autoinvest-option="auto">Auto</div>
+        <div data-qa-autoinvest-option="manual">Manual</div>
+      </div>
+      <div class="button complete-button">Complete</div>`;
+    $("[data-qa-autoinvest-option='manual']", creation).onclick = (event) =>
+      event.target.classList.add("selected");
+    $(".complete-button", creation).onclick = () =>
+      api.save(name, holdings).then(() =>
+        later(() => {
+          editor = null;
+          showPies();
+        })
+      );
+  });
+}
+
+// --- start up ---
+
+$(".main-tabs div.portfolio-icon").onclick = showPortfolio;
+loadPies().then(() => later(() => $("#platform-loader").remove()));
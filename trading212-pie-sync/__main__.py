@@ -2,16 +2,24 @@ import os
 import sys
 import logging
 import argparse
-import json
-import csv
-
-from selenium.common.exceptions import InvalidArgumentException
+from pathlib import Path
 
+from rich.console import Console
 from rich.logging import RichHandler
+from rich.table import Table
 from rich.traceback import install as install_rich_tracebacks
 
-from driver import ChromeDriver
-from navigator import Navigator
+import api
+from backend import FallbackBackend, HttpBackend, SeleniumBackend
+from catalog import InstrumentCatalog
+from resolver import TickerResolver
+from export import manifest_drift, state_drift, write_snapshot
+from latency import latencies
+from manifest import load_manifest, run_manifest
+from state import SyncState
+from sync import load_source, load_substitutions
+from timings import tracer
+from watch import watch_source
 
 install_rich_tracebacks()
 
@@ -31,6 +39,67 @@ def main():
         "when using this option, there's no need to supply email, password or pie name.",
     )
 
+    argparser.add_argument(
+        "--manifest",
+        help="Sync all the pies listed in this .json (or .yaml) manifest file, each "
+        "with its own source and substitutions. When using this option, there's no "
+        "need to supply the pie name.",
+    )
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=2,
+        help="The amount of browser sessions to sync the manifest pies with in parallel",
+    )
+
+    argparser.add_argument(
+        "--export-pies",
+        help="Export the holdings of all your pies to this .jsonl (or .csv) file in a "
+        "single session, and show how far each one drifted from its source: the one "
+        "in --manifest if given, otherwise the allocation it was last synced with. "
+        "When using this option, there's no need to supply the pie name.",
+    )
+
+    argparser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep a logged in headless browser session open and accept sync jobs "
+        "as json POST requests to /sync. When using this option, there's no need "
+        "to supply the pie name.",
+    )
+    argparser.add_argument(
+        "--port",
+        type=int,
+        default=8212,
+        help="The local port the daemon listens on for sync jobs",
+    )
+    argparser.add_argument(
+        "--recycle-after",
+        type=int,
+        default=50,
+        help="Restart the daemon's browser session after this amount of sync jobs",
+    )
+    argparser.add_argument(
+        "--max-memory",
+        type=int,
+        help="Restart the daemon's browser session when it uses more than this "
+        "amount of memory, in MB",
+    )
+
+    argparser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep the browser open and sync the pie again every time the "
+        "--from-json or --from-csv file changes",
+    )
+    argparser.add_argument(
+        "--debounce",
+        type=float,
+        default=2,
+        help="Wait for the source file to stop changing for this amount of seconds "
+        "before syncing it in watch mode",
+    )
+
     if not "--fetch-available-equities" in sys.argv:
         argparser.add_argument(
             "username", help="The email to log into your Trading212 account"
@@ -38,21 +107,23 @@ def main():
         argparser.add_argument(
             "password", help="The password to log into your Trading212 account"
         )
-        argparser.add_argument(
-            "pie", help="The name of the pie to update (case-sensitive)"
-        )
+        if not any(
+            option in sys.argv for option in ("--manifest", "--daemon", "--export-pies")
+        ):
+            argparser.add_argument(
+                "pie", help="The name of the pie to update (case-sensitive)"
+            )
 
     argparser.add_argument(
         "--from-json",
-        type=argparse.FileType("r"),
         help="Parse the list of holdings to update from this .json file "
-        "with the format { [ticker]: [percentage], ... }",
+        "with the format { [ticker]: [percentage], ... }, or .jsonl file with "
+        "one holding per line (optionally gzipped)",
     )
     argparser.add_argument(
         "--from-csv",
-        type=argparse.FileType("r"),
         help="Parse the list of holdings to update from this .csv file "
-        "with the format [ticker],[percentage] for each line",
+        "with the format [ticker],[percentage] for each line (optionally gzipped)",
     )
     argparser.add_argument(
         "--from-shared-pie",
@@ -64,7 +135,59 @@ def main():
         default="substitutions.json",
         help="Parse a list of replacement tickers from this .json file, "
         "To be used when a ticker is not found. The list format is "
-        "{ [original ticker]: [ticker to use if original not found], ... }",
+        "{ [original ticker]: [ticker to use if original not found], ... }, "
+        "or { [original ticker]: [[first candidate], [second candidate], ...], ... }",
+    )
+    argparser.add_argument(
+        "--catalog",
+        help="Keep a local catalog of the instruments available on Trading212 in this "
+        ".json file, and use it to skip searching for tickers that can't be found",
+    )
+    argparser.add_argument(
+        "--catalog-ttl",
+        type=float,
+        default=24,
+        help="Refresh the local instruments catalog when older than this amount of hours",
+    )
+    argparser.add_argument(
+        "--ticker-cache-ttl",
+        type=float,
+        default=7 * 24,
+        help="Remember which tickers were found or not found when searched for this "
+        "amount of hours, so missing ones aren't searched for again",
+    )
+    argparser.add_argument(
+        "--backend",
+        choices=["browser", "http", "auto"],
+        default="browser",
+        help="How to talk to Trading212: drive the website in a browser, call a "
+        "JSON api directly, or call the api for read-only operations (shared pies, "
+        "available instruments) and fall back to the browser when needed. The api "
+        "is the one of the local stand-in, so http and auto require --base-url",
+    )
+    argparser.add_argument(
+        "--base-url",
+        help="The root of the Trading212 website, e.g. to use a local stand-in "
+        "(https://www.trading212.com by default with the browser backend)",
+    )
+    argparser.add_argument(
+        "--capture-network",
+        action="store_true",
+        help="Read pies, shared pies and search results from the JSON responses "
+        "received by the browser, rather than from the page",
+    )
+    argparser.add_argument(
+        "--lean",
+        action="store_true",
+        help="Run the browser without images, media, fonts, trackers and other "
+        "unneeded features, to load pages faster and use less memory",
+    )
+    argparser.add_argument(
+        "--lookup-tabs",
+        type=int,
+        default=4,
+        help="Search for the instruments to add in this amount of browser tabs at "
+        "the same time, before editing the pie (0 to search them one by one)",
     )
     argparser.add_argument(
         "-c",
@@ -72,10 +195,53 @@ def main():
         action="store_true",
         help="Do not commit changes automatically and wait for user to confirm",
     )
+    argparser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Sync the pie even if its source hasn't changed since the last sync",
+    )
+    argparser.add_argument(
+        "--max-age",
+        type=float,
+        help="Sync the pie even if its source hasn't changed, when the last sync "
+        "happened more than this amount of hours ago",
+    )
+    argparser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Only print the changes that would be made to the pie, without applying them",
+    )
+    argparser.add_argument(
+        "-t",
+        "--timings",
+        action="store_true",
+        help="Print a summary of the time and WebDriver commands taken by each step",
+    )
+    argparser.add_argument(
+        "--fixed-timeouts",
+        action="store_true",
+        help="Always wait for the default timeouts, rather than the ones learned "
+        "from how long the website took in previous runs",
+    )
+    argparser.add_argument(
+        "--trace",
+        help="Export the timings of each step to this .json file, in the chrome "
+        "trace event format",
+    )
     argparser.add_argument(
         "-v", "--verbose", action="store_true", help="Increase output log verbosity"
     )
     args = argparser.parse_args()
+    # the JSON api the http backend calls isn't Trading212's own, so there's no
+    # default website for it
+    if args.backend != "browser" and not args.base_url:
+        argparser.error(
+            f"--backend {args.backend} requires the --base-url of a website serving "
+            "the stand-in's JSON api"
+        )
+    args.base_url = args.base_url or "https://www.trading212.com"
 
     # configure logging for the application
     log.setLevel(logging.INFO if not args.verbose else logging.DEBUG)
@@ -84,57 +250,261 @@ def main():
     log.addHandler(rich_handler)
     log.propagate = False
 
-    # initialize chromedriver
-    try:
-        driver = ChromeDriver()
-        n = Navigator(driver)
-    except InvalidArgumentException as e:
-        log.error(
-            f"Error initalising ChromeDriver: {e}"
-            + "Is another automated Chrome window still open?"
+    if args.timings or args.trace:
+        tracer.enable(export_path=args.trace)
+
+    # the latencies of the website are still recorded with fixed timeouts, so
+    # they can be used later on
+    latencies.load(Path.cwd() / "state" / "latency.json")
+    latencies.enabled = not args.fixed_timeouts
+
+    catalog = None
+    if args.catalog:
+        catalog = InstrumentCatalog(args.catalog, ttl=args.catalog_ttl * 60 * 60)
+    resolver = TickerResolver(
+        Path.cwd() / "state" / "tickers.json",
+        catalog=catalog,
+        ttl=args.ticker_cache_ttl * 60 * 60,
+    )
+
+    # the browser based modes import Selenium only when they're used
+    if args.daemon:
+        from daemon import SyncDaemon
+
+        daemon = SyncDaemon(
+            args.username,
+            args.password,
+            catalog=catalog,
+            resolver=resolver,
+            base_url=args.base_url,
+            lookup_tabs=args.lookup_tabs,
+            recycle_after=args.recycle_after,
+            max_memory=args.max_memory << 20 if args.max_memory else None,
+            profile=Path.cwd() / "profiles" / "daemon",
+            capture_network=args.capture_network,
+            lean=args.lean,
+        )
+        daemon.serve(port=args.port)
+        sys.exit(0)
+
+    if args.watch:
+        if not args.from_json and not args.from_csv:
+            argparser.error("--watch requires a --from-json or --from-csv source")
+        from daemon import SyncDaemon
+
+        daemon = SyncDaemon(
+            args.username,
+            args.password,
+            catalog=catalog,
+            resolver=resolver,
+            base_url=args.base_url,
+            lookup_tabs=args.lookup_tabs,
+            recycle_after=args.recycle_after,
+            max_memory=args.max_memory << 20 if args.max_memory else None,
+            profile=Path.cwd() / "profiles" / "watch",
+            capture_network=args.capture_network,
+            lean=args.lean,
+        )
+        watch_source(
+            daemon,
+            args.pie,
+            args.from_json or args.from_csv,
+            format=None if args.from_json else "csv",
+            substitutions=load_substitutions(args.substitutions),
+            catalog=catalog,
+            debounce=args.debounce,
+            dry_run=args.dry_run,
+            force=args.force,
         )
         sys.exit(0)
 
+    if args.manifest and not args.export_pies:
+        jobs = load_manifest(
+            args.manifest,
+            default_substitutions=args.substitutions.name if args.substitutions else None,
+        )
+        log.info(f"Syncing {len(jobs)} pies with {args.workers} workers")
+        results = run_manifest(
+            jobs,
+            args.username,
+            args.password,
+            workers=args.workers,
+            catalog=catalog,
+            resolver=resolver,
+            base_url=args.base_url,
+            lookup_tabs=args.lookup_tabs,
+            dry_run=args.dry_run,
+            force=args.force,
+            max_age=args.max_age * 60 * 60 if args.max_age is not None else None,
+            capture_network=args.capture_network,
+            lean=args.lean,
+        )
+        print_results(results)
+        sys.exit(0 if all(result.success for result in results) else 1)
+
+    # if the source is a local file, check whether it has changed since the last
+    # sync before even starting the browser
+    state = SyncState()
+    max_age = args.max_age * 60 * 60 if args.max_age is not None else None
+    source = args.from_shared_pie or args.from_json or args.from_csv
+    substitutions = load_substitutions(args.substitutions)
+    options = api.SyncOptions(
+        substitutions=substitutions,
+        catalog=catalog,
+        resolver=resolver,
+        state=state,
+        dry_run=args.dry_run,
+        force=args.force,
+        max_age=max_age,
+        source=source,
+        await_confirm=args.await_confirm,
+    )
+    account = (args.username, args.password)
+
+    def prepare_source(data):
+        # exits if the holdings haven't changed since the last sync, the same way
+        # sync_pie would skip them, but without starting a browser for it
+        if api.is_synced(account, args.pie, data, options):
+            sys.exit(0)
+        return data
+
+    data = None
+    if not any((args.fetch_available_equities, args.export_pies, args.from_shared_pie)):
+        data = prepare_source(
+            load_source(
+                None,
+                from_json=args.from_json,
+                from_csv=args.from_csv,
+                substitutions=substitutions,
+                catalog=catalog,
+            )
+        )
+
+    # the browser is only started once something needs it
+    navigators = []
+
+    def get_navigator():
+        if not navigators:
+            from selenium.common.exceptions import InvalidArgumentException
+
+            from driver import ChromeDriver
+            from navigator import Navigator
+
+            try:
+                driver = ChromeDriver(
+                    capture_network=args.capture_network, lean=args.lean
+                )
+            except InvalidArgumentException as e:
+                log.error(
+                    f"Error initalising ChromeDriver: {e}"
+                    + "Is another automated Chrome window still open?"
+                )
+                sys.exit(0)
+            navigators.append(
+                Navigator(
+                    driver,
+                    catalog=catalog,
+                    base_url=args.base_url,
+                    resolver=resolver,
+                    lookup_tabs=args.lookup_tabs,
+                )
+            )
+        return navigators[0]
+
+    # read-only operations can go through the website's JSON api, without a browser
+    if args.backend == "browser":
+        backend = SeleniumBackend(get_navigator())
+    else:
+        backend = HttpBackend(args.base_url, resolver=resolver)
+        if args.backend == "auto":
+            backend = FallbackBackend(backend, lambda: SeleniumBackend(get_navigator()))
+
+    if args.export_pies:
+        # read all the pies in a single session, and compare them with their sources
+        backend.login(args.username, args.password)
+        pies = backend.export_pies()
+        if args.manifest:
+            jobs = load_manifest(
+                args.manifest,
+                default_substitutions=args.substitutions.name if args.substitutions else None,
+            )
+            drift = manifest_drift(pies, jobs, backend, catalog=catalog)
+        else:
+            drift = state_drift(pies, state, args.username)
+        write_snapshot(pies, args.export_pies, drift)
+        print_drift(pies, drift)
+        sys.exit(0)
+
     if args.fetch_available_equities:
         file = args.fetch_available_equities
-        instruments = n.get_available_instruments()
+        instruments = backend.available_instruments()
+        if catalog is not None:
+            catalog.update(instruments)
         file.write(" ".join(instruments))
         log.info(f"Exported {len(instruments)} instruments to {file.name}")
         sys.exit(0)
 
+    # shared pies don't need logging in, so if they haven't changed
+    # since the last sync there's nothing else to do
+    if args.from_shared_pie:
+        data = prepare_source(backend.read_shared_pie(args.from_shared_pie))
+
+    # refresh the instruments catalog if it's missing or outdated
+    if catalog is not None and catalog.is_stale():
+        log.info("Refreshing the available instruments catalog")
+        catalog.update(backend.available_instruments())
+
     # start the application
-    data = {"instruments": {}}
-    if args.from_json:
-        data = json.load(args.from_json)
-    elif args.from_csv:
-        reader = csv.reader(args.from_csv)
-        data = {rows[0]: rows[1] for rows in reader}
-    elif args.from_shared_pie:
-        data = n.parse_shared_pie(args.from_shared_pie)
-
-    n.open_dashboard(args.username, args.password)
-    n.select_pie(args.pie)
-    current_instruments = n.get_current_instruments_tickers()
-    unused = [
-        ticker
-        for ticker in current_instruments
-        if ticker not in data.keys() or round(float(data[ticker]), 1) < 0.5
-    ]
-    substitutions = json.load(args.substitutions) if args.substitutions else {}
-    for ticker in unused:
-        n.remove_instrument(ticker)
-    for ticker, distribution in data.items():
-        n.rebalance_instrument(ticker, distribution, substitutions)
-    n.redistribute_pie()
-    if not args.await_confirm:
-        n.commit_pie_edits(name=args.pie)
+    if args.backend == "http":
+        api.sync_pie(account, args.pie, data, options, backend=backend)
     else:
-        input("Confirm changes and then press Enter to close the browser...")
+        api.sync_pie(account, args.pie, data, options, navigator=get_navigator())
+
+
+def print_drift(pies, drift):
+    # prints a summary table of the exported pies and their drift from their sources
+    table = Table(title="Exported pies")
+    for column in ("Pie", "Instruments", "Drift"):
+        table.add_column(column)
+    for pie, holdings in pies.items():
+        if holdings is None:
+            table.add_row(pie, "?", "[red]unreadable[/red]")
+            continue
+        if pie not in drift:
+            status = "[dim]no source[/dim]"
+        elif drift[pie]:
+            status = f"[yellow]{len(drift[pie])} changes[/yellow]"
+            for line in drift[pie].describe():
+                log.info(f"[{pie}] {line}")
+        else:
+            status = "[green]in sync[/green]"
+        table.add_row(pie, str(len(holdings)), status)
+    Console().print(table)
+
+
+def print_results(results):
+    # prints a summary table of the outcome of each pie synced from a manifest
+    table = Table(title="Sync results")
+    for column in ("Pie", "Worker", "Result", "Changes", "Time"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result.pie,
+            str(result.worker),
+            "[green]OK[/green]" if result.success else f"[red]{result.error}[/red]",
+            str(result.changes),
+            f"{result.duration:.1f}s",
+        )
+    Console().print(table)
 
 
 if __name__ == "__main__":
     try:
-        main()
+        try:
+            main()
+        finally:
+            latencies.save()
+            tracer.report()
     except KeyboardInterrupt:
         log.critical("Interrupted by user")
         try:
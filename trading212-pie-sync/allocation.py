@@ -0,0 +1,44 @@
+import heapq
+import logging
+
+from planner import MAX_INSTRUMENTS, MIN_WEIGHT
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+def solve_allocation(
+    holdings, min_weight=MIN_WEIGHT, max_instruments=MAX_INSTRUMENTS
+):
+    # turns a holdings allocation of any scale, { [ticker]: [weight] }, into one
+    # that Trading212 accepts as is: at most 50 instruments, none under 0.5%, with
+    # weights in 0.1 steps adding up to exactly 100, so the pie never needs to be
+    # redistributed after the targets are set
+    weights = ((float(weight), ticker) for ticker, weight in holdings.items())
+    kept = heapq.nlargest(
+        max_instruments, ((w, t) for w, t in weights if w > 0), key=lambda h: h[0]
+    )
+    if not kept:
+        return {}
+
+    # drop the smallest holdings until every remaining one is worth at least the
+    # minimum weight once scaled up to 100% - dropping one only grows the others
+    total = sum(weight for weight, _ in kept)
+    while len(kept) > 1 and kept[-1][0] * 100 / total < min_weight:
+        total -= kept.pop()[0]
+    dropped = len(holdings) - len(kept)
+    if dropped:
+        log.info(f"Dropped {dropped} holdings under the pie limits")
+
+    # largest remainder method: give each holding the whole 0.1 steps of its share,
+    # then hand out the steps left over to the holdings with the largest remainders
+    units = 1000
+    exact = [weight * units / total for weight, _ in kept]
+    allocated = [int(share) for share in exact]
+    leftover = units - sum(allocated)
+    by_remainder = sorted(
+        range(len(kept)), key=lambda i: exact[i] - allocated[i], reverse=True
+    )
+    for i in by_remainder[:leftover]:
+        allocated[i] += 1
+
+    return {ticker: steps / 10 for (_, ticker), steps in zip(kept, allocated)}
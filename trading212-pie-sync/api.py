@@ -0,0 +1,215 @@
+import logging
+import time
+from collections import namedtuple
+from collections.abc import Mapping
+
+from allocation import solve_allocation
+from backend import HttpBackend, SeleniumBackend
+from journal import SyncJournal
+from planner import SyncPlan, plan_sync
+from sources import collect_holdings, parse_entry
+from state import SyncState
+from sync import sync_backend, sync_pie as sync_session
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# The outcome of syncing a pie: the plan of changes (applied, or only planned on
+# a dry run) along with its description, and whether the sync was skipped since
+# the pie was already synced with the same holdings
+SyncReport = namedtuple(
+    "SyncReport", ["pie", "plan", "changes", "skipped", "dry_run", "duration"]
+)
+
+
+class SyncOptions:
+    # How a pie is synced by sync_pie. The backend is either "browser" or "http",
+    # and the browser options only apply when a new browser has to be started. The
+    # http backend calls the JSON api of the local stand-in, so it needs the
+    # base_url of a website serving it
+    def __init__(
+        self,
+        substitutions=None,
+        catalog=None,
+        resolver=None,
+        state=None,
+        dry_run=False,
+        force=False,
+        max_age=None,
+        source=None,
+        backend="browser",
+        base_url=None,
+        await_confirm=False,
+        headless=True,
+        capture_network=False,
+        lean=False,
+        lookup_tabs=4,
+    ):
+        self.substitutions = substitutions or {}
+        self.catalog = catalog
+        self.resolver = resolver
+        # the store of the allocations last applied to the pies, which the pies
+        # already synced with the same holdings are skipped with
+        self.state = state
+        self.dry_run = dry_run
+        self.force = force
+        self.max_age = max_age
+        # where the holdings came from, as recorded in the state
+        self.source = source
+        self.backend = backend
+        self.base_url = base_url
+        self.await_confirm = await_confirm
+        self.headless = headless
+        self.capture_network = capture_network
+        self.lean = lean
+        self.lookup_tabs = lookup_tabs
+
+
+def prepare_holdings(holdings, substitutions={}, catalog=None):
+    # validates holdings given as a { [ticker]: [weight] } mapping, or any iterable
+    # of (ticker, weight) pairs or json-like entries (e.g. from a generator), the
+    # same way holdings files are. Raises a ValueError if none of them are valid
+    if isinstance(holdings, Mapping):
+        rows = holdings.items()
+    else:
+        rows = (pair for entry in holdings for pair in parse_entry(entry))
+    data = collect_holdings(rows, substitutions, catalog)
+    if not data:
+        raise ValueError("No valid holdings to sync")
+    return data
+
+
+def plan_pie(pie, current, holdings, options=None):
+    # works out the changes to sync a pie, given its current holdings (e.g. from
+    # an export), without connecting to Trading212 at all
+    options = options or SyncOptions(dry_run=True)
+    started = time.time()
+    data = prepare_holdings(holdings, options.substitutions, options.catalog)
+    aliases = options.substitutions
+    if options.resolver is not None:
+        aliases = options.resolver.aliases(options.substitutions)
+    plan = plan_sync(current, solve_allocation(data), aliases)
+    return SyncReport(pie, plan, plan.describe(), False, True, time.time() - started)
+
+
+def _is_unchanged(username, pie, data, options, state):
+    # whether the pie was last synced with the same (prepared) holdings, and
+    # doesn't need syncing again
+    if options.force or not state.is_unchanged(
+        username,
+        pie,
+        data,
+        max_age=options.max_age,
+        substitutions=options.substitutions,
+    ):
+        return False
+    log.info(f"Pie {pie} already synced with its source, nothing to do")
+    return True
+
+
+def is_synced(account, pie, holdings, options=None):
+    # whether sync_pie would skip the pie for being already synced with the same
+    # holdings, which tells callers they don't need to start a browser for it
+    options = options or SyncOptions()
+    data = prepare_holdings(holdings, options.substitutions, options.catalog)
+    return _is_unchanged(account[0], pie, data, options, options.state or SyncState())
+
+
+def open_navigator(options, driver=None):
+    # a navigator on the given driver, or on a new browser. Selenium is only
+    # imported once a browser is actually needed
+    from driver import ChromeDriver
+    from navigator import Navigator
+    from resolver import TickerResolver
+
+    if driver is None:
+        driver = ChromeDriver(
+            headless=options.headless,
+            capture_network=options.capture_network,
+            lean=options.lean,
+        )
+    return Navigator(
+        driver,
+        catalog=options.catalog,
+        base_url=options.base_url or "https://www.trading212.com",
+        resolver=options.resolver or TickerResolver(catalog=options.catalog),
+        lookup_tabs=options.lookup_tabs,
+    )
+
+
+def sync_pie(
+    account, pie, holdings, options=None, driver=None, navigator=None, backend=None
+):
+    # syncs a pie of the (username, password) account with the given holdings,
+    # returning a SyncReport. The sync runs on a backend or navigator if given,
+    # on a new navigator for the driver if given, or otherwise on a new browser
+    # (or http backend) which is closed afterwards. With a password of None, the
+    # given session is expected to be logged in already
+    options = options or SyncOptions()
+    username, password = account
+    started = time.time()
+    data = prepare_holdings(holdings, options.substitutions, options.catalog)
+
+    def report(plan, skipped=False):
+        return SyncReport(
+            pie,
+            plan,
+            plan.describe(),
+            skipped,
+            options.dry_run,
+            time.time() - started,
+        )
+
+    # if the holdings haven't changed since the pie was last synced with them,
+    # there's nothing to do and no session to start
+    state = options.state or SyncState()
+    if _is_unchanged(username, pie, data, options, state):
+        return report(SyncPlan(), skipped=True)
+
+    # the backend or browser started here, which is closed once done
+    owned = None
+    journal = None
+    try:
+        if backend is None and navigator is None and options.backend == "http":
+            if not options.base_url:
+                raise ValueError("The http backend requires a base_url")
+            backend = owned = HttpBackend(options.base_url, resolver=options.resolver)
+        if backend is not None:
+            if password is not None:
+                backend.login(username, password)
+            plan = sync_backend(
+                backend, pie, data, options.substitutions, dry_run=options.dry_run
+            )
+        else:
+            if navigator is None:
+                navigator = open_navigator(options, driver)
+                if driver is None:
+                    owned = SeleniumBackend(navigator)
+            if password is not None:
+                navigator.open_dashboard(username, password)
+            journal = SyncJournal(username, pie)
+            plan = sync_session(
+                navigator,
+                pie,
+                data,
+                options.substitutions,
+                dry_run=options.dry_run,
+                await_confirm=options.await_confirm,
+                journal=journal,
+            )
+    finally:
+        if owned is not None:
+            owned.close()
+
+    # changes left for the user to confirm might not have been saved, so they
+    # aren't recorded and the next sync checks the pie again
+    if not options.dry_run and not options.await_confirm:
+        state.record(
+            username,
+            pie,
+            data,
+            source=options.source,
+            substitutions=options.substitutions,
+        )
+    if not options.dry_run and journal is not None:
+        journal.finish()
+    return report(plan)
@@ -0,0 +1,301 @@
+import json
+import logging
+from urllib.parse import urlencode, urlparse
+
+from allocation import solve_allocation
+from planner import substitutes
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# the paths of the website's JSON api used by the http backend, relative to its
+# base url. They match the local stand-in, and can be overridden for other setups
+HTTP_ENDPOINTS = {
+    "login": "/api/login",
+    "pies": "/api/pies",
+    "save_pie": "/api/pies",
+    "shared_pie": "/api/shared-pies/{id}",
+    "search": "/api/instruments/search",
+    "instruments": "/api/instruments",
+}
+
+
+class BackendError(Exception):
+    pass
+
+
+class Backend:
+    # The operations the sync needs from Trading212, implemented either by driving
+    # the website in a browser or by calling its JSON api directly. Pies holdings
+    # are always dictionaries of { [ticker]: [weight] }
+    def login(self, username, password):
+        raise NotImplementedError
+
+    def list_pies(self):
+        # returns the names of the user's pies
+        raise NotImplementedError
+
+    def read_pie(self, name):
+        raise NotImplementedError
+
+    def read_shared_pie(self, url):
+        raise NotImplementedError
+
+    def search_instrument(self, ticker):
+        # returns the code of the instrument listed with the ticker, or None
+        raise NotImplementedError
+
+    def available_instruments(self):
+        # returns the tickers of all the instruments available on Trading212
+        raise NotImplementedError
+
+    def apply_plan(self, pie, plan, substitutions={}):
+        # applies a sync plan to the pie and saves it
+        raise NotImplementedError
+
+    def export_pies(self):
+        # returns the holdings of all the user's pies, as { [name]: [holdings] }
+        return {name: self.read_pie(name) for name in self.list_pies()}
+
+    def close(self):
+        pass
+
+
+class SeleniumBackend(Backend):
+    # Drives the website in a browser through a Navigator
+    def __init__(self, navigator):
+        self.navigator = navigator
+
+    def login(self, username, password):
+        self.navigator.open_dashboard(username, password)
+
+    def list_pies(self):
+        return self.navigator.get_pies()
+
+    def read_pie(self, name):
+        return self.navigator.read_pie(name)
+
+    def read_shared_pie(self, url):
+        return self.navigator.parse_shared_pie(url)
+
+    def search_instrument(self, ticker):
+        navigator = self.navigator
+        if navigator.resolver.code(ticker) is None:
+            navigator.lookup_instruments([ticker], min_batch=1)
+        return navigator.resolver.code(ticker)
+
+    def available_instruments(self):
+        return self.navigator.get_available_instruments()
+
+    def export_pies(self):
+        return self.navigator.export_pies()
+
+    def apply_plan(self, pie, plan, substitutions={}):
+        self.navigator.select_pie(pie)
+        self.navigator.apply_plan(plan, substitutions)
+        self.navigator.commit_pie_edits(name=pie)
+
+    def close(self):
+        self.navigator.driver.quit()
+
+
+class HttpBackend(Backend):
+    # Calls the JSON api of the website over a pool of keep-alive connections,
+    # without starting a browser at all
+    def __init__(
+        self, base_url, endpoints=None, resolver=None, timeout=10, pool_manager=None
+    ):
+        import urllib3
+
+        self.base_url = base_url.rstrip("/")
+        self.endpoints = {**HTTP_ENDPOINTS, **(endpoints or {})}
+        self.resolver = resolver
+        self.http = pool_manager or urllib3.PoolManager(
+            maxsize=4, timeout=urllib3.Timeout(total=timeout), retries=2
+        )
+        self.cookies = {}
+
+    def request(self, method, endpoint, body=None, **params):
+        import urllib3
+
+        url = self.base_url + self.endpoints[endpoint].format(**params)
+        query = {key: value for key, value in params.items() if key != "id"}
+        if query:
+            url += "?" + urlencode(query)
+        headers = {"Accept": "application/json"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(body).encode()
+        try:
+            response = self.http.request(method, url, body=body, headers=headers)
+        except urllib3.exceptions.HTTPError as e:
+            raise BackendError(f"{method} {url} failed: {e}")
+        if response.status >= 400:
+            raise BackendError(f"{method} {url} failed with status {response.status}")
+        for cookie in response.headers.getlist("Set-Cookie"):
+            name, _, value = cookie.split(";", 1)[0].partition("=")
+            self.cookies[name.strip()] = value.strip()
+        try:
+            return json.loads(response.data.decode("utf-8"))
+        except ValueError:
+            raise BackendError(f"{method} {url} didn't return JSON")
+
+    def use_cookies(self, cookies):
+        # reuses the session of a logged in browser, as returned by get_cookies()
+        self.cookies.update({cookie["name"]: cookie["value"] for cookie in cookies})
+
+    def login(self, username, password):
+        self.request("POST", "login", {"email": username, "password": password})
+
+    def _pies(self):
+        try:
+            return {pie["name"]: pie["holdings"] for pie in self.request("GET", "pies")}
+        except (KeyError, TypeError):
+            raise BackendError("Unexpected pies data")
+
+    def list_pies(self):
+        return list(self._pies())
+
+    def read_pie(self, name):
+        # a pie that doesn't exist yet is empty, and is created when saved
+        return parse_holdings(self._pies().get(name, {}), allow_empty=True)
+
+    def export_pies(self):
+        return {
+            name: parse_holdings(holdings, allow_empty=True)
+            for name, holdings in self._pies().items()
+        }
+
+    def read_shared_pie(self, url):
+        shared_id = urlparse(url).path.rstrip("/").rsplit("/", 1)[-1]
+        return parse_holdings(self.request("GET", "shared_pie", id=shared_id))
+
+    def search_instrument(self, ticker):
+        ticker = ticker.upper()
+        results = self.request("GET", "search", query=f"({ticker})")
+        try:
+            for result in results:
+                if result["ticker"] == ticker:
+                    return result["code"]
+        except (KeyError, TypeError):
+            raise BackendError("Unexpected search results")
+        return None
+
+    def available_instruments(self):
+        instruments = self.request("GET", "instruments")
+        if not isinstance(instruments, list) or not instruments:
+            raise BackendError("Unexpected instruments data")
+        return [i["ticker"] if isinstance(i, dict) else i for i in instruments]
+
+    def _add_candidates(self, ticker, substitutions):
+        if self.resolver is not None:
+            return self.resolver.candidates(ticker, substitutions)
+        return [ticker] + substitutes(substitutions, ticker)
+
+    def apply_plan(self, pie, plan, substitutions={}):
+        # works out the holdings the plan results in, and saves them all at once
+        holdings = self.read_pie(pie)
+        for removal in plan.removals:
+            holdings.pop(removal.ticker, None)
+        # the targets set by the plan, summed for the tickers added as the same
+        # instrument (e.g. a substitution of a ticker that's in the source too)
+        targets = {}
+        for addition in plan.additions:
+            for candidate in self._add_candidates(addition.ticker, substitutions):
+                code = self.search_instrument(candidate)
+                if self.resolver is not None:
+                    self.resolver.record(candidate, found=bool(code), code=code)
+                if code:
+                    log.info(f"Adding instrument {candidate}")
+                    targets[candidate] = targets.get(candidate, 0) + addition.target
+                    if self.resolver is not None:
+                        self.resolver.record_resolution(addition.ticker, candidate)
+                    break
+            else:
+                log.error(f"Instrument {addition.ticker} not found!")
+        for rebalance in plan.rebalances:
+            targets[rebalance.ticker] = targets.get(rebalance.ticker, 0) + rebalance.target
+        holdings.update({ticker: round(target, 1) for ticker, target in targets.items()})
+        # the website redistributes pies that don't add up to 100%, so do the same
+        if round(sum(holdings.values()) * 10) != 1000:
+            holdings = solve_allocation(holdings)
+        self.request("POST", "save_pie", {"name": pie, "holdings": holdings})
+        if self.resolver is not None:
+            self.resolver.save()
+
+    def close(self):
+        self.http.clear()
+
+
+class FallbackBackend(Backend):
+    # Reads through a lightweight backend and falls back to a heavier one (started
+    # only when first needed) if it fails. Changes always go through the fallback
+    def __init__(self, primary, get_fallback):
+        self.primary = primary
+        self.get_fallback = get_fallback
+        self._fallback = None
+
+    @property
+    def fallback(self):
+        if self._fallback is None:
+            self._fallback = self.get_fallback()
+        return self._fallback
+
+    def _read(self, operation, *args):
+        try:
+            return getattr(self.primary, operation)(*args)
+        except BackendError as e:
+            log.debug(f"{operation} failed ({e}), falling back to the browser")
+            return getattr(self.fallback, operation)(*args)
+
+    def login(self, username, password):
+        self.fallback.login(username, password)
+
+    def list_pies(self):
+        return self.fallback.list_pies()
+
+    def read_pie(self, name):
+        return self.fallback.read_pie(name)
+
+    def export_pies(self):
+        return self.fallback.export_pies()
+
+    def read_shared_pie(self, url):
+        return self._read("read_shared_pie", url)
+
+    def search_instrument(self, ticker):
+        return self._read("search_instrument", ticker)
+
+    def available_instruments(self):
+        return self._read("available_instruments")
+
+    def apply_plan(self, pie, plan, substitutions={}):
+        self.fallback.apply_plan(pie, plan, substitutions)
+
+    def close(self):
+        self.primary.close()
+        if self._fallback is not None:
+            self._fallback.close()
+
+
+def parse_holdings(data, allow_empty=False):
+    # the { [ticker]: [weight] } holdings of a pie from the JSON api, which can be
+    # either an object of holdings or a list of { ticker, weight } slices
+    try:
+        if isinstance(data, dict):
+            data = data.get("holdings", data.get("instruments", data))
+        if isinstance(data, dict):
+            holdings = {str(ticker): float(weight) for ticker, weight in data.items()}
+        else:
+            holdings = {
+                str(item["ticker"]): float(item.get("weight", item.get("target")))
+                for item in data
+            }
+    except (KeyError, TypeError, ValueError, AttributeError):
+        raise BackendError("Unexpected pie data")
+    # an empty pie most likely means the data isn't what it was expected to be,
+    # and syncing with it would empty the pie
+    if not holdings and not allow_empty:
+        raise BackendError("No holdings in the pie data")
+    return holdings
@@ -0,0 +1,112 @@
+import json
+import logging
+import time
+from pathlib import Path
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+# the exchange suffixes tickers can be given with (as used by e.g. Yahoo Finance),
+# which are stripped to find an instrument. Other suffixes are part of the ticker,
+# like the share class in BRK.A and BRK.B, which are different instruments
+EXCHANGE_SUFFIXES = set(
+    "AS AX BR CO DE F HE HK IR JO KS L LS MC MI MX NS NZ OL PA SA SI SS ST SW SZ T "
+    "TO TW V VI WA".split()
+)
+
+
+def exchange_suffix(ticker):
+    # the exchange suffix of a ticker (0700.HK → HK), or None if it has none
+    base, _, suffix = ticker.strip().upper().rpartition(".")
+    return suffix if base and suffix in EXCHANGE_SUFFIXES else None
+
+
+def ticker_variants(ticker):
+    # returns the forms a ticker could be listed under, from the most to the least
+    # specific: as is, without the exchange suffix (0700.HK → 0700)
+    # and without leading zeroes (0700 → 700)
+    ticker = ticker.strip().upper()
+    variants = [ticker]
+    base = ticker.rsplit(".", 1)[0] if exchange_suffix(ticker) else ticker
+    for variant in (base, base.lstrip("0")):
+        if variant and variant not in variants:
+            variants.append(variant)
+    return variants
+
+
+class InstrumentCatalog:
+    # A local, on-disk cache of all the instruments available on Trading212,
+    # indexed by ticker so they can be checked without opening the search popup
+    def __init__(self, path, ttl=24 * 60 * 60):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.updated_at = 0
+        self.instruments = []
+        self._index = {}
+        # the tickers already warned about matching a listing on another exchange
+        self._warned = set()
+        self.load()
+
+    def load(self):
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return False
+        self.updated_at = data.get("updated_at", 0)
+        self._build(data.get("instruments", []))
+        log.debug(f"Loaded {len(self.instruments)} instruments from {self.path}")
+        return True
+
+    def update(self, instruments):
+        self.updated_at = time.time()
+        self._build(instruments)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(
+            json.dumps({"updated_at": self.updated_at, "instruments": self.instruments})
+        )
+        log.info(f"Saved {len(self.instruments)} instruments to {self.path}")
+
+    def is_stale(self):
+        return not self.instruments or time.time() - self.updated_at > self.ttl
+
+    def _build(self, instruments):
+        self.instruments = sorted(set(i.strip() for i in instruments if i.strip()))
+        # index every instrument by its exact ticker first, then by its variants,
+        # so an exact match always wins over an exchange-suffixed one
+        self._index = {}
+        for instrument in self.instruments:
+            self._index[instrument.upper()] = instrument
+        for instrument in self.instruments:
+            for variant in ticker_variants(instrument)[1:]:
+                self._index.setdefault(variant, instrument)
+
+    def lookup(self, ticker):
+        # returns the ticker the instrument is listed with on Trading212,
+        # or None if it's not available. A ticker listed on one exchange is never
+        # matched with the same ticker listed on another one. A ticker given with
+        # an exchange suffix can still match a listing without any, as that's how
+        # most instruments are listed, but nothing tells which exchange that one
+        # is on (T.TO isn't T), so such matches are warned about
+        suffix = exchange_suffix(ticker)
+        for variant in ticker_variants(ticker):
+            instrument = self._index.get(variant)
+            if instrument is None:
+                continue
+            listed_suffix = exchange_suffix(instrument)
+            if suffix and listed_suffix and listed_suffix != suffix:
+                continue
+            if suffix and not listed_suffix and ticker not in self._warned:
+                self._warned.add(ticker)
+                log.warning(
+                    f"Matched {ticker} with {instrument}, which might be listed on "
+                    f"another exchange than .{suffix}: use the ticker it's listed "
+                    "with on Trading212 if it's the wrong instrument"
+                )
+            return instrument
+        return None
+
+    def __contains__(self, ticker):
+        return self.lookup(ticker) is not None
+
+    def __len__(self):
+        return len(self.instruments)
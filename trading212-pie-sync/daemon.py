@@ -0,0 +1,205 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from selenium.common.exceptions import WebDriverException
+
+from api import SyncOptions, is_synced, prepare_holdings, sync_pie
+from driver import ChromeDriver
+from navigator import Navigator
+from state import SyncState
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+class SyncDaemon:
+    # Keeps a headless, logged in browser session warm and runs sync jobs on it,
+    # recycling the browser after a number of jobs or when it uses too much memory
+    def __init__(
+        self,
+        username,
+        password,
+        catalog=None,
+        resolver=None,
+        base_url="https://www.trading212.com",
+        lookup_tabs=4,
+        recycle_after=50,
+        max_memory=None,
+        **options,
+    ):
+        self.username = username
+        self.password = password
+        self.catalog = catalog
+        self.resolver = resolver
+        self.base_url = base_url
+        self.lookup_tabs = lookup_tabs
+        self.recycle_after = recycle_after
+        # maximum memory of the browser processes, in bytes
+        self.max_memory = max_memory
+        self.options = options
+        self.options.setdefault("headless", True)
+        self.state = SyncState()
+        self.navigator = None
+        self.jobs_done = 0
+        # jobs all share the same browser, so they have to run one at a time
+        self.lock = threading.Lock()
+
+    def start_session(self):
+        log.info("Starting browser session")
+        driver = ChromeDriver(**self.options)
+        self.navigator = Navigator(
+            driver,
+            catalog=self.catalog,
+            base_url=self.base_url,
+            resolver=self.resolver,
+            lookup_tabs=self.lookup_tabs,
+        )
+        self.navigator.open_dashboard(self.username, self.password)
+        self.jobs_done = 0
+
+    def stop_session(self):
+        if self.navigator is not None:
+            try:
+                self.navigator.driver.quit()
+            except WebDriverException:
+                pass
+            self.navigator = None
+
+    def needs_recycling(self):
+        if self.jobs_done >= self.recycle_after:
+            log.info(f"Recycling browser session after {self.jobs_done} jobs")
+            return True
+        if self.max_memory:
+            memory = self.navigator.driver.memory_usage()
+            if memory and memory > self.max_memory:
+                log.info(f"Recycling browser session using {memory >> 20}MB")
+                return True
+        return False
+
+    def session_valid(self):
+        return self.navigator.is_logged_in()
+
+    def ensure_session(self):
+        # make sure there's a live, logged in browser session to run the next job on
+        if self.navigator is not None and self.needs_recycling():
+            self.stop_session()
+        if self.navigator is None:
+            self.start_session()
+        elif not self.session_valid():
+            log.info("Browser session is not logged in anymore, logging in again")
+            try:
+                self.navigator.open_dashboard(self.username, self.password)
+            except WebDriverException:
+                # the browser itself is gone, start over with a fresh one
+                self.stop_session()
+                self.start_session()
+
+    def run(self, job):
+        # runs a sync job, a dictionary with the "pie" name and either the "holdings"
+        # to sync as { [ticker]: [percentage] } or a "from_shared_pie" URL, plus
+        # optional "substitutions", "dry_run", "force" and "source" keys
+        with self.lock:
+            started = time.time()
+            options = SyncOptions(
+                substitutions=job.get("substitutions", {}),
+                catalog=self.catalog,
+                state=self.state,
+                dry_run=job.get("dry_run", False),
+                force=job.get("force", False),
+                source=job.get("source", job.get("from_shared_pie")),
+            )
+            if job.get("from_shared_pie"):
+                self.ensure_session()
+                data = self.navigator.parse_shared_pie(job["from_shared_pie"])
+            else:
+                # an empty allocation would empty the pie, so it's rejected by
+                # is_synced (and sync_pie) rather than synced
+                data = job.get("holdings") or {}
+
+            # if the source hasn't changed since it was last synced, there's nothing to do
+            if is_synced((self.username, self.password), job["pie"], data, options):
+                return {"pie": job["pie"], "changes": [], "skipped": True}
+
+            # the browser is left on the shared pie page, which ensure_session
+            # takes back to the logged in app
+            self.ensure_session()
+            try:
+                report = sync_pie(
+                    (self.username, None),
+                    job["pie"],
+                    data,
+                    options,
+                    navigator=self.navigator,
+                )
+            finally:
+                self.jobs_done += 1
+            return {
+                "pie": job["pie"],
+                "changes": report.changes,
+                "duration": round(time.time() - started, 2),
+            }
+
+    def status(self):
+        memory = self.navigator.driver.memory_usage() if self.navigator else None
+        return {
+            "session": self.navigator is not None,
+            "jobs_done": self.jobs_done,
+            "memory": memory,
+        }
+
+    def serve(self, host="127.0.0.1", port=8212):
+        # accepts sync jobs as json POST requests on /sync, and reports the state
+        # of the browser session on GET /status
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path != "/status":
+                    return self.respond(404, {"error": "Not found"})
+                self.respond(200, daemon.status())
+
+            def do_POST(self):
+                if self.path != "/sync":
+                    return self.respond(404, {"error": "Not found"})
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    job = json.loads(self.rfile.read(length))
+                    if not job.get("pie"):
+                        return self.respond(400, {"error": "Missing pie name"})
+                    if not job.get("from_shared_pie"):
+                        job["holdings"] = prepare_holdings(
+                            job.get("holdings") or {},
+                            job.get("substitutions", {}),
+                            daemon.catalog,
+                        )
+                except (ValueError, TypeError) as e:
+                    return self.respond(400, {"error": f"Invalid job: {e}"})
+                try:
+                    self.respond(200, daemon.run(job))
+                except Exception as e:
+                    log.error(f"Failed to sync pie {job['pie']}: {e}")
+                    self.respond(500, {"error": str(e)})
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        # log in straight away, so the first job doesn't have to wait for it
+        with self.lock:
+            self.ensure_session()
+        server = HTTPServer((host, port), Handler)
+        log.info(f"Listening for sync jobs on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.stop_session()
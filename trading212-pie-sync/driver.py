@@ -1,48 +1,296 @@
+import base64
+import functools
+import json
+import logging
+import os
+import time
 from pathlib import Path
 
-from selenium.webdriver import Chrome
+from selenium.webdriver import Chrome, DesiredCapabilities
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import (
+    JavascriptException,
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
 
 import chromedriver_autoinstaller
 
+from latency import latencies
+from timings import WAIT, traced, tracer
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# the maximum time an asynchronous script can run for, which bounds the longest wait
+SCRIPT_TIMEOUT = 60
+
+# waits for a condition, the body of a javascript function receiving the list of
+# arguments as `args`, to return a truthy value. Rather than polling, the condition
+# is checked again on every change to the DOM, so the wait resolves as soon as it's
+# met. Resolves with the condition's value, or null if the timeout expires first.
+# The condition is inlined in the script rather than passed to `new Function`,
+# which the page's content security policy could forbid
+WAIT_SCRIPT = """
+const check = (args) => { /* condition */ };
+const args = arguments[0];
+const done = arguments[arguments.length - 1];
+const evaluate = () => {
+    try {
+        return check(args);
+    } catch (e) {
+        return null;
+    }
+};
+const result = evaluate();
+if (result) {
+    return done(result);
+}
+const observer = new MutationObserver(() => {
+    const result = evaluate();
+    if (result) {
+        observer.disconnect();
+        clearTimeout(timer);
+        done(result);
+    }
+});
+const timer = setTimeout(() => {
+    observer.disconnect();
+    done(null);
+}, arguments[1]);
+observer.observe(document, {
+    childList: true,
+    subtree: true,
+    attributes: true,
+    characterData: true,
+});
+"""
+
+
+# url patterns of the resources blocked in lean mode: images, media, fonts and the
+# analytics and tracking scripts, none of which are needed to edit pies
+LEAN_BLOCKED_URLS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.webp",
+    "*.svg",
+    "*.ico",
+    "*.mp4",
+    "*.webm",
+    "*.mp3",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*facebook.net*",
+    "*hotjar.com*",
+    "*segment.io*",
+    "*mixpanel.com*",
+    "*intercom.io*",
+    "*intercomcdn.com*",
+    "*sentry.io*",
+    "*onesignal.com*",
+]
+
+# chrome switches of lean mode, turning off the features a sync doesn't need
+LEAN_ARGUMENTS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-extensions",
+    "--disable-component-extensions-with-background-pages",
+    "--disable-default-apps",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-notifications",
+    "--disable-features=TranslateUI,MediaRouter,OptimizationHints,AutofillServerCommunication",
+    "--metrics-recording-only",
+    "--mute-audio",
+    "--no-first-run",
+]
+
+# the size of the profile's disk cache in lean mode, in bytes
+LEAN_DISK_CACHE_SIZE = 32 << 20
+
+
+# the messages of the javascript errors raised when the page navigates away from an
+# asynchronous script still running
+NAVIGATION_ERRORS = (
+    "document unloaded",
+    "execution context was destroyed",
+    "Cannot find context",
+)
+
+
 # higher-level abstraction methods to make selenium operations less verbose
-def wait_for(driver, selector, timeout=10):
-    WebDriverWait(driver, timeout).until(
-        EC.presence_of_element_located((By.CSS_SELECTOR, selector))
+@traced("wait_until", category=WAIT)
+def wait_until(driver, condition, *args, timeout=10, operation=None, expect_misses=False):
+    # with an operation name, the timeout is learned from how long the operation
+    # took in the past, the given one being its default. When a learned timeout
+    # shorter than the default expires, the wait goes on for the rest of the
+    # default one before giving up, and the next waits get more time. For an
+    # operation expected to time out (e.g. searching for something that might not
+    # be there) that only happens once the condition is met after all, since
+    # timing out is no sign of the learned timeout being too short
+    default = timeout
+    if operation is not None:
+        timeout = latencies.timeout(operation, timeout)
+    started = time.time()
+    deadline = started + timeout
+    retry = operation is not None and timeout < default
+    retried = False
+    while True:
+        remaining = max(deadline - time.time(), 0)
+        try:
+            result = driver.execute_async_script(
+                WAIT_SCRIPT.replace("/* condition */", condition),
+                list(args),
+                int(remaining * 1000),
+            )
+        except WebDriverException as e:
+            # a broken condition won't be met by waiting any longer, but a page
+            # navigating away is reported as a javascript error too
+            if isinstance(e, JavascriptException) and not any(
+                error in (e.msg or "") for error in NAVIGATION_ERRORS
+            ):
+                raise
+            # the page navigated away while waiting, wait again on the new page
+            if time.time() >= deadline:
+                result = None
+            else:
+                time.sleep(0.1)
+                continue
+        if not result and retry:
+            if not expect_misses:
+                latencies.expire(operation)
+            log.debug(f"Waiting up to the default {default}s for {operation}")
+            deadline = started + default
+            retry, retried = False, True
+            continue
+        if not result:
+            if operation is not None and (expect_misses or not retried):
+                latencies.expire(operation, expected=expect_misses)
+            waited = time.time() - started
+            raise TimeoutException(
+                f"Timed out after {waited:.1f}s waiting for: {operation or condition}"
+            )
+        if operation is not None:
+            latencies.observe(operation, time.time() - started)
+            if retried and expect_misses:
+                # met after the learned timeout, which would have made it a miss
+                latencies.expire(operation)
+        return result
+
+
+@traced("wait_for", category=WAIT)
+def wait_for(driver, selector, timeout=10, operation=None, expect_misses=False):
+    wqS(driver, selector, timeout, operation=operation, expect_misses=expect_misses)
+
+
+@traced("wait_for_not", category=WAIT)
+def wait_for_not(driver, selector, timeout=10, operation=None):
+    wait_until(
+        driver,
+        "return !document.querySelector(args[0])",
+        selector,
+        timeout=timeout,
+        operation=operation or f"gone {selector}",
     )
 
 
-def wait_for_not(driver, selector, timeout=10):
-    WebDriverWait(driver, timeout).until_not(
-        EC.presence_of_element_located((By.CSS_SELECTOR, selector))
+@traced("wait_for_count", category=WAIT)
+def wait_for_count(driver, selector, count, timeout=10, operation=None):
+    wait_until(
+        driver,
+        "return document.querySelectorAll(args[0]).length === args[1]",
+        selector,
+        count,
+        timeout=timeout,
+        operation=operation or f"count {selector}",
     )
 
 
+@traced("qS")
 def qS(driver, selector):
     return driver.find_element_by_css_selector(selector)
 
 
+@traced("qSS")
 def qSS(driver, selector):
     return driver.find_elements_by_css_selector(selector)
 
 
-def wqS(driver, selector, timeout=10):
-    wait_for(driver, selector, timeout)
-    return driver.find_element_by_css_selector(selector)
+@traced("wqS", category=WAIT)
+def wqS(driver, selector, timeout=10, operation=None, expect_misses=False):
+    # the selector names the operation the timeout is learned for, unless it varies
+    # between calls (e.g. it has the name of a pie in it), which should pass one
+    return wait_until(
+        driver,
+        "return document.querySelector(args[0])",
+        selector,
+        timeout=timeout,
+        operation=operation or selector,
+        expect_misses=expect_misses,
+    )
+
+
+# errors caused by the page changing under an operation, which are worth retrying
+# right away. Timeouts already waited long enough, so they're only worth resuming
+# the whole sync from a reloaded app for
+RETRIABLE_ERRORS = (StaleElementReferenceException,)
+RESUMABLE_ERRORS = (StaleElementReferenceException, TimeoutException)
+
 
+def retrying(attempts=3, backoff=0.25, max_backoff=2, on_retry=None):
+    # decorator retrying a function when the page changes under it, waiting twice
+    # as long before each attempt (up to max_backoff seconds). The function has to
+    # look its elements up again on each attempt, on_retry(*args) is called before
+    # retrying and can be used to refresh elements cached elsewhere
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return function(*args, **kwargs)
+                except RETRIABLE_ERRORS as e:
+                    if attempt == attempts - 1:
+                        raise
+                    delay = min(backoff * 2 ** attempt, max_backoff)
+                    log.debug(
+                        f"{function.__qualname__} failed ({type(e).__name__}), "
+                        f"retrying in {delay}s"
+                    )
+                    time.sleep(delay)
+                    if on_retry is not None:
+                        on_retry(*args)
 
+        return wrapper
+
+    return decorator
+
+
+@traced("wclick")
+@retrying()
+def wclick(driver, selector, timeout=10, operation=None):
+    # waits for an element and clicks it, looking it up again if it goes stale
+    wqS(driver, selector, timeout, operation=operation).click()
+
+
+@traced("qX")
 def qX(driver, xpath):
     return driver.find_element_by_xpath(xpath)
 
 
+@traced("qXX")
 def qXX(driver, xpath):
     return driver.find_elements_by_xpath(xpath)
 
 
+@traced("send_input")
 def send_input(field, value):
     field.click()
     field.send_keys(Keys.CONTROL + "a")
@@ -53,8 +301,83 @@ def send_input(field, value):
     field.send_keys("\t")
 
 
+# sets the value of a list of input fields in one go, going through the native value
+# setter so that the frameworks listening to the field pick up the change, and then
+# dispatching the events a user typing in the field would trigger.
+# Returns the value each field holds afterwards, so the caller can validate them
+SET_INPUTS_SCRIPT = """
+const setter = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, "value").set;
+return arguments[0].map(([field, value]) => {
+    field.focus();
+    setter.call(field, value);
+    for (const type of ["input", "change", "blur"]) {
+        field.dispatchEvent(new Event(type, { bubbles: true }));
+    }
+    return field.value;
+});
+"""
+
+
+@traced("set_inputs")
+def set_inputs(driver, values):
+    # sets the values of multiple input fields with a single script call, given a list of
+    # (field, value) pairs. Falls back to typing the value for the fields that didn't
+    # take it, and returns the list of fields that had to be typed in
+    values = [(field, str(value)) for field, value in values]
+    if not values:
+        return []
+    results = driver.execute_script(SET_INPUTS_SCRIPT, [list(pair) for pair in values])
+    retyped = []
+    for (field, value), result in zip(values, results):
+        try:
+            valid = float(result) == float(value)
+        except (TypeError, ValueError):
+            valid = result == value
+        if not valid:
+            send_input(field, value)
+            retyped.append(field)
+    return retyped
+
+
+def process_tree_rss(pid):
+    # returns the total resident memory, in bytes, of a process and all of its
+    # descendants by walking /proc. Only supported on linux, returns None elsewhere
+    proc = Path("/proc")
+    if not proc.exists():
+        return None
+    children = {}
+    rss = {}
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # the process name can contain spaces, so split after its closing bracket
+            stat = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+            statm = (entry / "statm").read_text().split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(stat[1]), []).append(int(entry.name))
+        rss[int(entry.name)] = int(statm[1]) * page_size
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        total += rss.get(current, 0)
+        pending.extend(children.get(current, []))
+    return total
+
+
 class ChromeDriver(Chrome):
-    def __init__(self, *args, headless=False, **kwargs):
+    def __init__(
+        self,
+        *args,
+        headless=False,
+        profile=None,
+        capture_network=False,
+        lean=False,
+        **kwargs,
+    ):
         chromedriver_path = chromedriver_autoinstaller.install()
         logs_path = Path.cwd() / "logs" / "webdrive.log"
         logs_path.parent.mkdir(parents=True, exist_ok=True)
@@ -63,16 +386,142 @@ class ChromeDriver(Chrome):
         if headless:
             chrome_options.add_argument("--headless")
             chrome_options.add_argument("window-size=1920,1080")
-        chrome_options.add_argument("user-data-dir=" + str(Path.cwd() / "profile"))
+        # each browser session needs its own profile directory, as chrome
+        # refuses to start on a profile that's already in use
+        profile = Path(profile) if profile else Path.cwd() / "profile"
+        chrome_options.add_argument("user-data-dir=" + str(profile))
         chrome_options.add_argument("--no-sandbox")
         chrome_options.add_argument("--disable-dev-shm-usage")
         chrome_options.add_argument("--log-level=4")
         chrome_options.add_argument("--silent")
         chrome_options.add_argument("--disable-logging")
+        # instruments are looked up in several tabs at once, which need to keep
+        # running at full speed while in the background
+        chrome_options.add_argument("--disable-background-timer-throttling")
+        chrome_options.add_argument("--disable-backgrounding-occluded-windows")
+        chrome_options.add_argument("--disable-renderer-backgrounding")
         chrome_options.add_experimental_option("excludeSwitches", ["enable-logging"])
+        if lean:
+            for argument in LEAN_ARGUMENTS:
+                chrome_options.add_argument(argument)
+            chrome_options.add_argument(f"--disk-cache-size={LEAN_DISK_CACHE_SIZE}")
+            # block images and media through the content settings as well, which
+            # also covers the ones the url patterns miss (e.g. data urls)
+            chrome_options.add_experimental_option(
+                "prefs",
+                {
+                    "profile.managed_default_content_settings.images": 2,
+                    "profile.managed_default_content_settings.media_stream": 2,
+                    "profile.default_content_setting_values.notifications": 2,
+                },
+            )
+
+        capabilities = DesiredCapabilities.CHROME.copy()
+        if capture_network:
+            # log the network events of the browser, so the JSON responses fetched
+            # by the website can be read back through the DevTools protocol
+            capabilities["goog:loggingPrefs"] = {"performance": "ALL"}
 
         super().__init__(
             executable_path=str(chromedriver_path),
             service_log_path=str(logs_path),
             options=chrome_options,
-        )
\ No newline at end of file
+            desired_capabilities=capabilities,
+        )
+        self.set_script_timeout(SCRIPT_TIMEOUT)
+        self.capture_network = capture_network
+        self.lean = lean
+        if lean:
+            self.block_resources()
+        # the JSON responses received since the capture was last cleared,
+        # as { url, request_id } dictionaries
+        self._responses = []
+
+    def block_resources(self):
+        # blocks the lean mode resources in the current tab, and any page it
+        # navigates to next. New tabs have to be blocked separately
+        self.execute_cdp_cmd("Network.enable", {})
+        self.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+
+    def page_load_time(self):
+        # the time it took to load the current page, in seconds
+        duration = self.execute_script(
+            "const [entry] = performance.getEntriesByType('navigation');"
+            "return entry ? entry.duration : null;"
+        )
+        return duration / 1000 if duration is not None else None
+
+    def execute(self, driver_command, params=None):
+        # count every command sent over the WebDriver wire
+        tracer.count_command(driver_command)
+        return super().execute(driver_command, params)
+
+    def memory_usage(self):
+        # the resident memory used by chromedriver and all the browser processes
+        return process_tree_rss(self.service.process.pid)
+
+    def captured_responses(self):
+        # collects the JSON responses received since the last call from the
+        # performance log, which is emptied every time it's read
+        for entry in self.get_log("performance"):
+            message = json.loads(entry["message"])["message"]
+            if message["method"] != "Network.responseReceived":
+                continue
+            response = message["params"]["response"]
+            if "json" in response.get("mimeType", ""):
+                self._responses.append(
+                    {"url": response["url"], "request_id": message["params"]["requestId"]}
+                )
+        return self._responses
+
+    def clear_responses(self):
+        # forgets the responses received so far, to only wait for the ones
+        # triggered by what happens next
+        self.captured_responses()
+        self._responses = []
+
+    def response_json(self, response):
+        body = self.execute_cdp_cmd(
+            "Network.getResponseBody", {"requestId": response["request_id"]}
+        )
+        text = body["body"]
+        if body.get("base64Encoded"):
+            text = base64.b64decode(text).decode("utf-8")
+        return json.loads(text)
+
+    @traced("wait_for_response", category=WAIT)
+    def wait_for_response(self, matches, timeout=10, poll=0.1, operation=None):
+        # waits for a JSON response whose url satisfies the matches function,
+        # and returns its parsed body. As with wait_until, an operation name makes
+        # the timeout a learned one, extended to the default one once if it expires
+        if not self.capture_network:
+            raise WebDriverException("Network capture is not enabled")
+        default = timeout
+        if operation is not None:
+            timeout = latencies.timeout(operation, timeout)
+        started = time.time()
+        deadline = started + timeout
+        retry = operation is not None and timeout < default
+        retried = False
+        while True:
+            for response in self.captured_responses():
+                if not matches(response["url"]):
+                    continue
+                try:
+                    data = self.response_json(response)
+                except WebDriverException:
+                    # the body isn't available until the response has finished loading
+                    continue
+                self._responses.remove(response)
+                if operation is not None:
+                    latencies.observe(operation, time.time() - started)
+                return data
+            if time.time() > deadline and retry:
+                latencies.expire(operation)
+                deadline = started + default
+                retry, retried = False, True
+            elif time.time() > deadline:
+                if operation is not None and not retried:
+                    latencies.expire(operation)
+                raise TimeoutException("No matching network response received")
+            time.sleep(poll)
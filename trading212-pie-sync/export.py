@@ -0,0 +1,84 @@
+import csv
+import json
+import logging
+import time
+from pathlib import Path
+
+from allocation import solve_allocation
+from planner import plan_sync
+from sync import load_source, load_substitutions
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+def write_snapshot(pies, path, drift={}):
+    # saves the holdings of the exported pies to a .csv file, one [pie],[ticker],
+    # [target] row per instrument, or otherwise a json-lines file with one object
+    # per pie along with its drift from its source, if known. Unreadable pies (with
+    # holdings of None) have no rows, and are marked as such in json-lines files
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    exported_at = time.time()
+    with path.open("w", newline="") as file:
+        if path.suffix.lower() == ".csv":
+            writer = csv.writer(file)
+            writer.writerow(["pie", "ticker", "target"])
+            for pie, holdings in pies.items():
+                for ticker, target in (holdings or {}).items():
+                    writer.writerow([pie, ticker, target])
+        else:
+            for pie, holdings in pies.items():
+                entry = {"pie": pie, "holdings": holdings, "exported_at": exported_at}
+                if holdings is None:
+                    entry["unreadable"] = True
+                if pie in drift:
+                    entry["drift"] = drift[pie].describe()
+                file.write(json.dumps(entry) + "\n")
+    log.info(f"Exported {len(pies)} pies to {path}")
+
+
+def pie_drift(current, holdings, substitutions={}):
+    # the changes it would take to sync a pie with the given source holdings
+    return plan_sync(current, solve_allocation(holdings), substitutions)
+
+
+def manifest_drift(pies, jobs, backend, catalog=None):
+    # compares the exported pies with the sources they are configured to sync
+    # with in a manifest, returning the plan of changes for each of them
+    drift = {}
+    for job in jobs:
+        if job.pie not in pies:
+            log.warning(f"Pie {job.pie} of the manifest doesn't exist")
+            continue
+        if pies[job.pie] is None:
+            continue
+        substitutions = {}
+        try:
+            if job.substitutions:
+                with open(job.substitutions) as file:
+                    substitutions = load_substitutions(file)
+            if job.from_shared_pie:
+                holdings = backend.read_shared_pie(job.from_shared_pie)
+            else:
+                holdings = load_source(
+                    None,
+                    from_json=job.from_json,
+                    from_csv=job.from_csv,
+                    substitutions=substitutions,
+                    catalog=catalog,
+                )
+        except Exception as e:
+            log.error(f"Couldn't read the source of pie {job.pie}: {e}")
+            continue
+        drift[job.pie] = pie_drift(pies[job.pie], holdings, substitutions)
+    return drift
+
+
+def state_drift(pies, state, account):
+    # compares the exported pies with the allocations last applied to them
+    drift = {}
+    for pie, current in pies.items():
+        entry = state.get(account, pie)
+        if entry is not None and current is not None:
+            drift[pie] = pie_drift(current, entry["allocation"])
+    return drift
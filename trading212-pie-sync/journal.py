@@ -0,0 +1,55 @@
+import json
+import logging
+import re
+import time
+from pathlib import Path
+
+from state import account_key, fingerprint
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+class SyncJournal:
+    # An append-only log of the operations done by the sync of a pie, as JSON lines.
+    # It's removed once the sync is over, so a journal left behind means the last
+    # run was interrupted, and tells the next one how far it went
+    def __init__(self, account, pie, directory=None):
+        directory = Path(directory or Path.cwd() / "state" / "journal")
+        name = re.sub(r"[^\w-]+", "_", pie)
+        self.path = directory / f"{account_key(account)}-{name}.jsonl"
+
+    def entries(self):
+        try:
+            lines = self.path.read_text().splitlines()
+        except OSError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the last line might have been cut short by the crash
+                break
+        return entries
+
+    def record(self, op, **fields):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a") as file:
+            file.write(json.dumps({"op": op, "at": time.time(), **fields}) + "\n")
+
+    def resume(self, holdings):
+        # starts the journal of a sync to the given holdings, returning the
+        # operations done by an interrupted run syncing the same holdings, if any
+        entries = self.entries()
+        if entries and entries[0].get("fingerprint") == fingerprint(holdings):
+            self.record("resume")
+            return [entry for entry in entries[1:] if entry["op"] != "resume"]
+        self.finish()
+        self.record("start", fingerprint=fingerprint(holdings))
+        return []
+
+    def finish(self):
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
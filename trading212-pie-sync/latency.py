@@ -0,0 +1,150 @@
+import json
+import logging
+import threading
+from collections import Counter
+from pathlib import Path
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# upper bounds of the histogram buckets, in seconds: 25% wider each, from 50ms
+# up to a few minutes, which keeps the timeouts derived from them within 25%
+BUCKETS = [0.05 * 1.25 ** i for i in range(40)]
+
+
+class LatencyStats:
+    # Learns how long the website takes for each kind of wait, keeping a histogram
+    # of the observed latencies per operation, and derives the timeouts of the
+    # waits from them: a high percentile of the latencies times a margin, so runs
+    # fail fast when the website is quick and wait longer when it's slow. Until an
+    # operation has enough samples, its default timeout is used
+    def __init__(
+        self,
+        path=None,
+        percentile=0.99,
+        margin=1.5,
+        minimum=0.5,
+        ceiling=3,
+        min_samples=20,
+        decay=0.99,
+    ):
+        self.path = Path(path) if path else None
+        self.enabled = True
+        self.percentile = percentile
+        self.margin = margin
+        # the shortest timeout, in seconds, and the longest one as a multiple of
+        # the default timeout of the operation
+        self.minimum = minimum
+        self.ceiling = ceiling
+        self.min_samples = min_samples
+        # the older samples fade away by this factor on every new one, so that the
+        # histograms follow the website when it gets slower or faster
+        self.decay = decay
+        # { [operation]: [count of samples in each bucket] }
+        self.histograms = {}
+        # timeouts expired during this run, by operation, which stretch the next
+        # timeouts of the operation until it succeeds again
+        self.expired = Counter()
+        self.escalation = Counter()
+        # the default timeout each operation was last waited for with
+        self.defaults = {}
+        # the waits can happen on the threads of several manifest workers
+        self.lock = threading.Lock()
+
+    def load(self, path=None):
+        if path is not None:
+            self.path = Path(path)
+        if self.path is None:
+            return False
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return False
+        self.histograms = {
+            operation: counts
+            for operation, counts in data.get("operations", {}).items()
+            if len(counts) == len(BUCKETS)
+        }
+        return True
+
+    def save(self):
+        if self.path is None or not self.histograms:
+            return
+        with self.lock:
+            data = {"operations": self.histograms}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(data))
+
+    def observe(self, operation, seconds):
+        # records how long an operation took to succeed
+        with self.lock:
+            counts = self.histograms.setdefault(operation, [0] * len(BUCKETS))
+            for i, count in enumerate(counts):
+                counts[i] = count * self.decay
+            index = next(
+                (i for i, bound in enumerate(BUCKETS) if seconds <= bound),
+                len(BUCKETS) - 1,
+            )
+            counts[index] += 1
+            if self.escalation[operation]:
+                self.escalation[operation] -= 1
+
+    def expire(self, operation, expected=False):
+        # records that an operation timed out. Unless timing out is an expected
+        # outcome (e.g. searching for an instrument that isn't listed), the next
+        # timeouts of the operation are stretched by the margin, so the retries of
+        # an operation that's slower than usual get more time
+        with self.lock:
+            self.expired[operation] += 1
+            if not expected:
+                self.escalation[operation] += 1
+                log.debug(f"Waiting longer for {operation} after timing out")
+
+    def samples(self, operation):
+        return sum(self.histograms.get(operation, ()))
+
+    def quantile(self, operation, q):
+        # the upper bound of the bucket the q-th quantile of the latencies falls
+        # in, or None without any samples
+        counts = self.histograms.get(operation)
+        total = sum(counts) if counts else 0
+        if not total:
+            return None
+        cumulative = 0
+        for bound, count in zip(BUCKETS, counts):
+            cumulative += count
+            if cumulative >= q * total:
+                return bound
+        return BUCKETS[-1]
+
+    def timeout(self, operation, default):
+        # the timeout for the next wait of an operation, in seconds
+        self.defaults[operation] = default
+        if not self.enabled:
+            return default
+        stretch = self.margin ** self.escalation[operation]
+        if self.samples(operation) < self.min_samples:
+            learned = default
+        else:
+            learned = self.quantile(operation, self.percentile) * self.margin
+        return min(max(learned * stretch, self.minimum), default * self.ceiling)
+
+    def summary(self):
+        # the latency percentiles and current timeout of each operation waited for
+        # during this run, the ones with the most samples first
+        rows = []
+        for operation, default in list(self.defaults.items()):
+            rows.append(
+                {
+                    "operation": operation,
+                    "samples": self.samples(operation),
+                    "p50": self.quantile(operation, 0.5),
+                    "p95": self.quantile(operation, 0.95),
+                    "p99": self.quantile(operation, 0.99),
+                    "timeout": self.timeout(operation, default),
+                    "expired": self.expired[operation],
+                }
+            )
+        return sorted(rows, key=lambda row: row["samples"], reverse=True)
+
+
+latencies = LatencyStats()
@@ -0,0 +1,218 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import api
+from planner import SyncPlan
+from state import SyncState
+from sync import load_source, load_substitutions
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# A single pie to sync, as listed in a manifest file. The source and
+# substitutions are paths (or an URL for shared pies)
+SyncJob = namedtuple(
+    "SyncJob",
+    ["pie", "from_json", "from_csv", "from_shared_pie", "substitutions"],
+)
+
+# The outcome of a sync job, collected for the run summary
+JobResult = namedtuple(
+    "JobResult", ["pie", "worker", "success", "changes", "duration", "error"]
+)
+
+
+def load_manifest(path, default_substitutions=None):
+    # reads the list of pies to sync from a .json file or, if PyYAML is installed,
+    # a .yaml file. The manifest is either a list of jobs or an object with a "pies"
+    # list, and each job has a "pie" name plus one of the "from_json", "from_csv"
+    # or "from_shared_pie" sources and optionally its own "substitutions" file.
+    # The default substitutions file is used as is, rather than relative to the
+    # manifest, unless it comes from the manifest itself
+    path = Path(path)
+    with path.open() as file:
+        if path.suffix in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("PyYAML is required to read .yaml manifest files")
+            manifest = yaml.safe_load(file)
+        else:
+            manifest = json.load(file)
+
+    # relative paths in the manifest are relative to the manifest itself
+    def resolve(value):
+        return str(path.parent / value) if value else None
+
+    if isinstance(manifest, dict):
+        if manifest.get("substitutions"):
+            default_substitutions = resolve(manifest["substitutions"])
+        manifest = manifest.get("pies", [])
+
+    jobs = []
+    for entry in manifest:
+        if not entry.get("pie"):
+            raise ValueError(f"Manifest entry {entry} has no pie name")
+        jobs.append(
+            SyncJob(
+                pie=entry["pie"],
+                from_json=resolve(entry.get("from_json")),
+                from_csv=resolve(entry.get("from_csv")),
+                from_shared_pie=entry.get("from_shared_pie"),
+                substitutions=resolve(entry["substitutions"])
+                if entry.get("substitutions")
+                else default_substitutions,
+            )
+        )
+    return jobs
+
+
+def run_job(
+    get_navigator,
+    job,
+    username,
+    password,
+    state,
+    catalog=None,
+    dry_run=False,
+    force=False,
+    max_age=None,
+):
+    # files are only read when the job runs, so a missing one only fails its own job
+    substitutions = {}
+    if job.substitutions:
+        with open(job.substitutions) as file:
+            substitutions = load_substitutions(file)
+
+    # local sources are read without a browser, which is only started
+    # (by get_navigator) if the pie actually needs syncing
+    data = load_source(
+        get_navigator() if job.from_shared_pie else None,
+        from_json=job.from_json,
+        from_csv=job.from_csv,
+        from_shared_pie=job.from_shared_pie,
+        substitutions=substitutions,
+        catalog=catalog,
+    )
+
+    options = api.SyncOptions(
+        substitutions=substitutions,
+        catalog=catalog,
+        state=state,
+        dry_run=dry_run,
+        force=force,
+        max_age=max_age,
+        source=job.from_shared_pie or job.from_json or job.from_csv,
+    )
+    # if the source hasn't changed since it was last synced, there's nothing to do
+    if api.is_synced((username, password), job.pie, data, options):
+        return SyncPlan()
+
+    # the worker's session is logged in once, and again only if it was lost (or
+    # the browser is on a shared pie page)
+    navigator = get_navigator()
+    if not navigator.is_logged_in():
+        navigator.open_dashboard(username, password)
+    return api.sync_pie(
+        (username, None), job.pie, data, options, navigator=navigator
+    ).plan
+
+
+def run_manifest(
+    jobs,
+    username,
+    password,
+    workers=2,
+    profiles_dir=None,
+    catalog=None,
+    resolver=None,
+    base_url="https://www.trading212.com",
+    lookup_tabs=4,
+    dry_run=False,
+    force=False,
+    max_age=None,
+    **options,
+):
+    # syncs all the jobs across a bounded pool of workers, each with its own
+    # browser session and profile directory so they don't step on each other
+    profiles_dir = Path(profiles_dir or Path.cwd() / "profiles")
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+    results = []
+    results_lock = threading.Lock()
+    state = SyncState()
+
+    def work(worker):
+        navigators = []
+
+        # only start the browser once there's work for it to do
+        def get_navigator():
+            if not navigators:
+                from driver import ChromeDriver
+                from navigator import Navigator
+
+                driver = ChromeDriver(
+                    profile=profiles_dir / f"worker-{worker}", **options
+                )
+                navigators.append(
+                    Navigator(
+                        driver,
+                        catalog=catalog,
+                        base_url=base_url,
+                        resolver=resolver,
+                        lookup_tabs=lookup_tabs,
+                    )
+                )
+            return navigators[0]
+
+        try:
+            while True:
+                try:
+                    job = pending.get_nowait()
+                except queue.Empty:
+                    return
+                started = time.time()
+                try:
+                    log.info(f"Worker {worker} syncing pie {job.pie}")
+                    plan = run_job(
+                        get_navigator,
+                        job,
+                        username,
+                        password,
+                        state,
+                        catalog=catalog,
+                        dry_run=dry_run,
+                        force=force,
+                        max_age=max_age,
+                    )
+                    result = JobResult(
+                        job.pie, worker, True, len(plan), time.time() - started, None
+                    )
+                except Exception as e:
+                    log.error(f"Worker {worker} failed to sync pie {job.pie}: {e}")
+                    result = JobResult(
+                        job.pie, worker, False, 0, time.time() - started, str(e)
+                    )
+                with results_lock:
+                    results.append(result)
+        finally:
+            for navigator in navigators:
+                navigator.driver.quit()
+
+    threads = [
+        threading.Thread(target=work, args=(worker,), daemon=True)
+        for worker in range(min(workers, len(jobs)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # return the results in the same order as the jobs in the manifest
+    order = {job.pie: index for index, job in enumerate(jobs)}
+    return sorted(results, key=lambda result: order[result.pie])
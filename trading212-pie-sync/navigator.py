@@ -1,26 +1,57 @@
 import json
 import logging
-from decimal import Decimal, getcontext
-from math import copysign, remainder
+import re
+import time
+from collections import namedtuple
+from urllib.parse import parse_qs, urlparse
 
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import (
-    StaleElementReferenceException,
     NoSuchElementException,
     TimeoutException,
+    WebDriverException,
 )
 from selenium.webdriver.common.keys import Keys
 
-from driver import qS, qSS, wqS, qX, qXX, wait_for, wait_for_not, send_input
+from driver import (
+    qS,
+    wqS,
+    wait_for,
+    wait_for_not,
+    wait_for_count,
+    wait_until,
+    wclick,
+    retrying,
+    send_input,
+    set_inputs,
+)
+from backend import BackendError, parse_holdings
+from latency import latencies
+from resolver import TickerResolver
+from timings import traced
 
 log = logging.getLogger(f"trading-212-sync.{__name__}")
 
-# A custom selenium wait condition that waits until an instrument with a
+# the default time to wait for an instrument to show up in the search results,
+# before deciding it's not listed
+SEARCH_TIMEOUT = 2
+
+# A custom wait condition that waits until an instrument with a
 # specific ticker appears in the instruments search bar and returns the
 # [data-qa-code] attribute for that instrument's cell
 class TickerFoundInInstrumentSearch(object):
+    CONDITION = """
+    const results = document.querySelectorAll(
+        ".search-results-content .search-results-instrument"
+    );
+    for (const instrument of results) {
+        const symbol = instrument.querySelector(".cell-symbol");
+        if (symbol && symbol.textContent === args[0]) {
+            return instrument.getAttribute("data-qa-code");
+        }
+    }
+    return false;
+    """
+
     def __init__(self, search_field, ticker):
         self.search_field = search_field
         self.ticker = ticker
@@ -29,32 +60,172 @@ class TickerFoundInInstrumentSearch(object):
         self.search_field.send_keys(Keys.DELETE)
         self.search_field.send_keys(f"({ticker.upper()})")
 
-    def __call__(self, driver):
-        results = qSS(driver, ".search-results-content .search-results-instrument")
-        if not len(results):
-            return False
-        for instrument in results:
-            try:
-                code = instrument.get_attribute("data-qa-code")
-                cell = qS(driver, f".search-results-instrument[data-qa-code='{code}'")
-                secondary_name = qS(cell, ".cell-symbol")
-                if (
-                    secondary_name.get_attribute("textContent")
-                    == f"{self.ticker.upper()}"
-                ):
-                    return instrument.get_attribute("data-qa-code")
-            except StaleElementReferenceException:
-                pass
-        return False
+    def wait(self, driver, timeout=SEARCH_TIMEOUT):
+        return wait_until(
+            driver,
+            self.CONDITION,
+            self.ticker.upper(),
+            timeout=timeout,
+            operation="search",
+            expect_misses=True,
+        )
+
+    def check(self, driver):
+        # checks the search results once, without waiting for them
+        return driver.execute_script(
+            "const args = arguments[0];" + self.CONDITION, [self.ticker.upper()]
+        )
+
+
+# A single instrument slice in the pie editor, as returned by the snapshot script
+Slice = namedtuple("Slice", ["ticker", "weight", "locked", "lock", "element"])
+
+# reads the ticker, current weight and lock state of the instruments in the pie
+# editor in a single round-trip, along with the element handle of their container.
+# The lock state is only known from the markup for the "locked" class; the markup
+# of the lock button is returned as well, so a change of state can be told apart
+# by comparing it over time whatever the button looks like
+SNAPSHOT_SCRIPT = """
+return Array.from(document.querySelectorAll(".bucket-instrument-personalisation"))
+    .map(container => {
+        const name = container.querySelector(".instrument-logo-name");
+        const field = container.querySelector(".instrument-share-container .spinner input");
+        const lock = container.querySelector(".lock-unlock-tooltip");
+        return {
+            ticker: name ? name.textContent.trim() : "",
+            weight: field ? parseFloat(field.value) || 0 : 0,
+            locked: !!lock && (lock.classList.contains("locked") || !!lock.querySelector(".locked")),
+            lock: lock ? lock.outerHTML : null,
+            element: container,
+        };
+    });
+"""
+
+# extracts the [ticker, target] pairs of all the instruments of a shared pie, given
+# the XPath of the instruments rows and the XPaths of the ticker and target elements
+# relative to each row. Text is read from the DOM rather than from what's rendered,
+# so there's no need to expand the instruments container hidden by the overflow
+SHARED_PIE_SCRIPT = """
+const query = (xpath, node, type) =>
+    document.evaluate(xpath, node, null, type, null);
+const rows = query(arguments[0], document, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE);
+const holdings = [];
+for (let i = 0; i < rows.snapshotLength; i++) {
+    const row = rows.snapshotItem(i);
+    const ticker = query(arguments[1], row, XPathResult.FIRST_ORDERED_NODE_TYPE);
+    const target = query(arguments[2], row, XPathResult.FIRST_ORDERED_NODE_TYPE);
+    if (ticker.singleNodeValue && target.singleNodeValue) {
+        holdings.push([
+            ticker.singleNodeValue.textContent.trim(),
+            target.singleNodeValue.textContent.trim(),
+        ]);
+    }
+}
+return holdings;
+"""
+
+# reads the ticker and target of every instrument listed in the holdings tab of a
+# pie, which unlike the pie editor doesn't need the pie to be in edit mode
+HOLDINGS_SCRIPT = """
+return Array.from(document.querySelectorAll(".bucket-holdings .bucket-holding"))
+    .map(row => {
+        const name = row.querySelector(".instrument-logo-name");
+        const target = row.querySelector(".bucket-holding-target");
+        return [
+            row.getAttribute("data-qa-ticker") || (name ? name.textContent.trim() : ""),
+            target ? parseFloat(target.textContent) || 0 : 0,
+        ];
+    });
+"""
+
+# checks that the browser is still on the logged in platform, without navigating
+SESSION_CHECK_SCRIPT = (
+    "return !!document.querySelector('.main-tabs')"
+    " && !document.querySelector('input[name=password]')"
+)
+
+# clicks the lock buttons of the given (locked) instrument containers, all in one go
+UNLOCK_SCRIPT = """
+for (const container of arguments[0]) {
+    const lock = container.querySelector(".lock-unlock-tooltip");
+    if (lock) lock.click();
+}
+"""
+
+# regexes matching the paths of the website's JSON api requests whose responses are
+# read instead of scraping the page, when the driver captures the network traffic
+API_ENDPOINTS = {
+    "shared_pie": r"/shared-pies/[^/]+$",
+    "pies": r"/pies$",
+    "search": r"/instruments/search$",
+}
+
+
+def refresh_snapshot(navigator, *args):
+    # scrapes the pie editor again before retrying an operation, so that it
+    # works on fresh elements rather than stale ones
+    navigator.get_pie_snapshot(refresh=True)
 
 
 class Navigator:
-    def __init__(self, driver):
+    def __init__(
+        self,
+        driver,
+        catalog=None,
+        base_url="https://www.trading212.com",
+        resolver=None,
+        lookup_tabs=4,
+        endpoints=None,
+    ):
         self.driver = driver
+        # the root of the Trading212 website, which can be pointed to a local
+        # stand-in for testing and benchmarking
+        self.base_url = base_url.rstrip("/")
+        # an optional InstrumentCatalog, used to skip searching for instruments
+        # that are not available on Trading212
+        self.catalog = catalog
+        # works out which tickers to search for, and remembers which ones weren't
+        # found. Unless one is given, its cache only lasts as long as the navigator
+        self.resolver = resolver or TickerResolver(catalog=catalog)
+        # how many browser tabs to search for instruments with at the same time,
+        # before adding them to the pie
+        self.lookup_tabs = lookup_tabs
+        self.endpoints = {**API_ENDPOINTS, **(endpoints or {})}
+        # the user's pies as read from the JSON api, { [name]: { [ticker]: [weight] } }
+        self.pies = None
+        # in-memory index of the pie editor slices, keyed by ticker. It's scraped
+        # once and then kept up to date as instruments are added or removed
+        self._slices = None
+
+    @property
+    def capture_network(self):
+        # whether the driver captures the JSON responses fetched by the website
+        return getattr(self.driver, "capture_network", False)
+
+    def clear_responses(self):
+        if self.capture_network:
+            self.driver.clear_responses()
+
+    def api_response(self, endpoint, timeout=10, **query):
+        # waits for the website to fetch from one of the API_ENDPOINTS, with
+        # the given query parameters, and returns the JSON data it received
+        pattern = re.compile(self.endpoints[endpoint])
+
+        def matches(url):
+            url = urlparse(url)
+            params = parse_qs(url.query)
+            return bool(pattern.search(url.path)) and all(
+                params.get(key, [None])[0] == value for key, value in query.items()
+            )
 
+        return self.driver.wait_for_response(
+            matches, timeout=timeout, operation=f"{endpoint} response"
+        )
+
+    @traced()
     def open_dashboard(self, username, password):
         #self.driver.get("https://www.trading212.com")
-        self.driver.get("https://www.trading212.com/en/login")
+        self.driver.get(f"{self.base_url}/en/login")
         #self.driver.get("https://live.trading212.com/beta")
 
         try:
@@ -81,156 +252,176 @@ class Navigator:
             pass
         wait_for(self.driver, ".main-tabs")
 
+    def is_logged_in(self):
+        try:
+            return bool(self.driver.execute_script(SESSION_CHECK_SCRIPT))
+        except WebDriverException:
+            return False
+
+    @traced()
+    def reload_app(self):
+        # reloads the app, dropping any unsaved pie edits and open popups, without
+        # having to log in again
+        self._slices = None
+        self.driver.refresh()
+        wait_for(self.driver, ".main-tabs")
+        wait_for_not(self.driver, "#platform-loader")
+
+    @traced()
     def parse_shared_pie(self, url):
         # navigate to the shared pie page and wait for it to load fully
+        self.clear_responses()
         self.driver.get(url)
-        WebDriverWait(self.driver, 10).until_not(
-            EC.presence_of_element_located((By.CSS_SELECTOR, "div[role=progressbar]"))
-        )
+        if self.capture_network:
+            # the holdings come straight from the JSON the page loads them from
+            try:
+                return parse_holdings(self.api_response("shared_pie"))
+            except (TimeoutException, ValueError, BackendError) as e:
+                log.debug(f"Shared pie data not captured, parsing the page: {e}")
+        wait_for_not(self.driver, "div[role=progressbar]")
         # parsing shared pie pages is a pain!
         # all the classes names are scrambled so we'll do all our parsing by XPaths
         # querying styling. This will likely require maintenance in the future
         instruments_xpath = "//div[contains(@style,'border-left-color') and contains(@style,'background-color: rgb(254, 254, 254)')]"
-        instruments = qXX(self.driver, instruments_xpath)
-        WebDriverWait(self.driver, 10).until(lambda d: len(instruments) > 0)
-
-        container = qX(instruments[0], "./../..")
-        # expands the instruments container height or else the driver will fail to
-        # access them as they will be hidden by the overflow
-        self.driver.execute_script("arguments[0].style='height: auto'", container)
-
-        holdings = {}
-        for instrument in instruments:
-            ticker = qX(
-                instrument,
-                ".//div[contains(@style,'color: rgb(116, 121, 128)') and contains(@style, 'font-size: 12px;')]",
-            ).text
-            target = qX(instrument, ".//div[contains(text(), '%')]").text
-            holdings[ticker] = float(target.strip("%"))
-        return holdings
+        wait_until(
+            self.driver,
+            "return document.evaluate(args[0], document, null, "
+            "XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue",
+            instruments_xpath,
+        )
+        # read all the instruments tickers and targets in a single script call,
+        # rather than running separate XPath queries for each instrument
+        rows = self.driver.execute_script(
+            SHARED_PIE_SCRIPT,
+            instruments_xpath,
+            ".//div[contains(@style,'color: rgb(116, 121, 128)') and contains(@style, 'font-size: 12px;')]",
+            ".//div[contains(text(), '%')]",
+        )
+        return {ticker: float(target.strip("%")) for ticker, target in rows}
+
+    def open_pies_tab(self):
+        # click the portfolio section, wait for it to load and then open the pies tab.
+        # The pies data is read again every time, so a failed capture doesn't
+        # leave the pies data of an earlier visit behind
+        self.pies = None
+        self.clear_responses()
+        wclick(self.driver, ".main-tabs div.portfolio-icon")
+        wait_for(self.driver, ".portfolio-section .investments-section")
+        wclick(self.driver, ".investments-section div[data-qa-tab=buckets]")
+        if self.capture_network:
+            try:
+                self.pies = {
+                    pie["name"]: parse_holdings(pie, allow_empty=True)
+                    for pie in self.api_response("pies")
+                }
+            except (TimeoutException, ValueError, KeyError, TypeError, BackendError) as e:
+                log.debug(f"Pies data not captured: {e}")
+
+    @traced()
+    def get_pies(self):
+        # returns the names of the user's pies, as listed in the pies tab
+        self.open_pies_tab()
+        wait_for(self.driver, ".buckets-list")
+        return self.driver.execute_script(
+            "return Array.from(document.querySelectorAll('.buckets-list .bucket-item'))"
+            ".map(item => item.getAttribute('data-qa-item'))"
+        )
+
+    @traced()
+    def read_pie(self, pie_name):
+        # reads the holdings of a pie from its holdings tab, without entering edit
+        # mode, as a dictionary of { [ticker]: [target] }
+        self.open_pies_tab()
+        wclick(
+            self.driver,
+            f".buckets-list .bucket-item[data-qa-item='{pie_name}']",
+            operation="pie item",
+        )
+        wclick(
+            self.driver,
+            ".bucket-advanced-tabs .bucket-advanced-tab[data-qa-tab=holdings]",
+        )
+        # a pie is only empty if the page says so, as a holdings tab that doesn't
+        # show up (or changed its layout) would otherwise read as an empty pie
+        try:
+            wait_until(
+                self.driver,
+                "return document.querySelector(args[0])"
+                " || document.querySelector(args[1])",
+                ".bucket-holdings .bucket-holding",
+                ".bucket-holdings .bucket-holdings-empty",
+                timeout=5,
+                operation="pie holdings",
+            )
+        except TimeoutException:
+            raise BackendError(f"Holdings of pie {pie_name} not found on the page")
+        rows = self.driver.execute_script(HOLDINGS_SCRIPT)
+        if not rows:
+            log.warning(f"Pie {pie_name} has no holdings")
+        return {ticker: float(target) for ticker, target in rows if ticker}
+
+    @traced()
+    def export_pies(self):
+        # reads the holdings of all the user's pies in one session, as a dictionary
+        # of { [pie name]: { [ticker]: [target] } }. With the network captured, the
+        # pies data loaded along with the pies list already has all of them.
+        # The pies whose holdings couldn't be read are exported as None
+        names = self.get_pies()
+        if self.pies is not None and all(name in self.pies for name in names):
+            return {name: self.pies[name] for name in names}
+        pies = {}
+        for name in names:
+            try:
+                pies[name] = self.read_pie(name)
+            except BackendError as e:
+                log.error(f"Couldn't read pie {name}: {e}")
+                pies[name] = None
+        return pies
 
+    @traced()
     def select_pie(self, pie_name):
-        # click the portfolio section, wait for it to load and then open the pies tab
-        wqS(self.driver, ".main-tabs div.portfolio-icon").click()
-        wait_for(self.driver, ".portfolio-section .investments-section")
-        wqS(self.driver, ".investments-section div[data-qa-tab=buckets]").click()
+        self._slices = None
+        self.open_pies_tab()
         try:
-            # attempt to click the pie we want to modify
+            # attempt to click the pie we want to modify, unless the pies data
+            # already tells it doesn't exist
+            if self.pies is not None and pie_name not in self.pies:
+                raise TimeoutException(f"Pie {pie_name} not in the pies data")
             wqS(
                 self.driver,
                 f".buckets-list .bucket-item[data-qa-item='{pie_name}']",
                 timeout=5,
+                operation="pie item",
             ).click()
         except TimeoutException:
             # if the pie is not found, create a new one
             # and start adding new instruments to it
             log.error(f"Pie {pie_name} not found, creating new pie!")
-            wqS(self.driver, f".buckets-list .bucket-creation-button").click()
-            wqS(self.driver, f".bucket-creation .add-instruments .button").click()
+            wclick(self.driver, f".buckets-list .bucket-creation-button")
+            wclick(self.driver, f".bucket-creation .add-instruments .button")
             return
 
         # click the holdings tab on the pie section, then the edit pie button
         # and wait for the pie editing window to appear
-        wqS(
+        wclick(
             self.driver,
             ".bucket-advanced-tabs .bucket-advanced-tab[data-qa-tab=holdings]",
-        ).click()
-        wqS(self.driver, ".edit-bucket-button").click()
+        )
+        wclick(self.driver, ".edit-bucket-button")
         wait_for(self.driver, ".bucket-customisation")
 
-    # def get_pie_distribution(self):
-    #     return float(
-    #         qS(
-    #             self.driver,
-    #             ".bucket-customisation-footer .slices-distribution-indicator",
-    #         )
-    #         .get_attribute("textContent")
-    #         .strip("%")
-    #     )
-
+    @traced()
     def redistribute_pie(self):
         # Trading212 now has a dedicated button for redistributing the pie
         # proportionally! So convennient.
         try:
             qS(self.driver, ".bucket-instruments-personalisation-header .adjust-slices-tooltip").click()
+            # every weight in the pie changes, so the cached snapshot is now outdated
+            self._slices = None
         except:
             log.debug("Pie does not need redistribution")
 
-        return;
-        # this code below is the old, lovingly handcrafted method.
-        # couldn't bear myself to delete it!
-        
-        # get the total percentage of all instruments' target in the pie
-        total_percentage = self.get_pie_distribution()
-        total_redistributed = Decimal(0.0)
-        rebalanced = False
-        if total_percentage != 100.0:
-            # if the total allocation percentage is less than 100, redistribute
-            # the remaining value across all instruments
-            log.info(f"Total pie percentage is {total_percentage}, redistributing to 100%")
-            containers = ".bucket-customisation .bucket-instruments-personalisation .bucket-instrument-personalisation"
-            for container in qSS(self.driver, containers):
-                field = qS(container, ".instrument-share-container .spinner input")
-                ticker = (
-                    qS(container, ".instrument-logo-name")
-                    .get_attribute("textContent")
-                    .strip()
-                )
-
-                # go through each instrument container, and spread the remainder
-                # proportionally according to its targets weight
-                old_value = float(field.get_attribute("value"))
-                new_value = round(old_value * 100.0 / total_percentage, 1)
-
-                # if the total redistribution is going to exceed 100, clamp the value
-                if (total_redistributed + Decimal(new_value)) > 100.0:
-                    rebalanced = True
-                    new_value = round((Decimal(100.0) - total_redistributed), 1)
-
-                # set the new redistributed value for the target
-                total_redistributed += Decimal(new_value)
-                if new_value != old_value:
-                    log.debug(f"Redistributing {ticker}: {old_value} → {new_value}")
-                    send_input(field, new_value)
-
-                if rebalanced:
-                    break
-
-            # if the pie distribution percentage still doesn't amount to 100%
-            # after redistribution (likely due to floating point calculation errors)
-            # spread the reminder across the top holdings (if positive), or subtract
-            # it from the bottom ones (if negative) until we reach 100%
-            distribution = self.get_pie_distribution()
-            if distribution != 100.0:
-                remainder = Decimal(100.0) - Decimal(distribution)
-                log.debug(
-                    f"Spreading out redistribution remainder ({round(remainder, 1)})"
-                )
-                fields = [
-                    field
-                    for field in qSS(
-                        self.driver,
-                        ".instrument-share-container .spinner input",
-                    )
-                ]
-                fields.sort(
-                    reverse=remainder > 0,
-                    key=lambda field: Decimal(field.get_attribute("value")),
-                )
-                for field in fields:
-                    value = float(field.get_attribute("value"))
-                    # Trading212 allocation values can't go under 0.5
-                    # so if we have a negative remainder and the current holding being
-                    # shaved off has a 0.5 allocation, skip it for the next lowest one
-                    if remainder < 0 and value == 0.5:
-                        continue
-                    offset = Decimal(copysign(0.1, remainder))
-                    new_value = round(Decimal(value) + offset, 1)
-                    send_input(field, new_value)
-                    remainder = remainder - offset
-                    if round(remainder, 1) == 0.0:
-                        break
-
+    @traced()
     def commit_pie_edits(self, name=""):
         try:
             # if a new pie is being created, fill the input field for the pie name
@@ -238,63 +429,271 @@ class Navigator:
             send_input(name_input, name)
             qS(self.driver, ".bucket-creation .button.complete-button").click()
             # then set up manual investing and complete the creation process
-            wqS(
+            wclick(
                 self.driver, ".bucket-creation [data-qa-autoinvest-option='manual']"
-            ).click()
+            )
             qS(self.driver, ".bucket-creation .button.complete-button").click()
         except NoSuchElementException:
             # if we are editing an existing pie, just confirm the changes
             qS(self.driver, ".bucket-customisation-footer .complete-button").click()
 
+    @traced()
+    def get_pie_snapshot(self, refresh=False):
+        # returns the cached index of the slices in the pie editor,
+        # scraping it in a single script call if it's not available yet
+        if self._slices is None or refresh:
+            slices = self.driver.execute_script(SNAPSHOT_SCRIPT)
+            self._slices = {
+                instrument["ticker"]: Slice(**instrument) for instrument in slices
+            }
+        return self._slices
+
+    @traced()
     def get_current_instruments_tickers(self):
         # returns a list of all the tickers of the instruments that are
         # currently included in the pies
-        ticker_selector = ".bucket-instrument-personalisation .instrument-logo-name"
-        return [
-            element.get_attribute("textContent")
-            for element in qSS(self.driver, ticker_selector)
+        return list(self.get_pie_snapshot())
+
+    @traced()
+    def get_current_instruments(self):
+        # returns a snapshot of the pie as a dictionary of
+        # { [ticker]: [current weight] } for every instrument in the pie
+        return {
+            ticker: instrument.weight
+            for ticker, instrument in self.get_pie_snapshot().items()
+        }
+
+    @traced()
+    def apply_plan(self, plan, substitutions={}, journal=None):
+        # executes a sync plan computed by the planner, only touching the
+        # instruments whose allocation actually changes. Each completed
+        # operation is written to the journal, if given
+        def record(op, **fields):
+            if journal is not None:
+                journal.record(op, **fields)
+
+        self.lookup_instruments(
+            [addition.ticker for addition in plan.additions], substitutions
+        )
+        for removal in plan.removals:
+            self.remove_instrument(removal.ticker)
+            record("remove", ticker=removal.ticker)
+        targets = {}
+        added = self.add_instruments(
+            [addition.ticker for addition in plan.additions], substitutions
+        )
+        for addition in plan.additions:
+            if addition.ticker in added:
+                # tickers added as the same instrument (e.g. a substitution of a
+                # ticker that's in the source too) share a single slice
+                added_ticker = added[addition.ticker]
+                targets[added_ticker] = round(
+                    targets.get(added_ticker, 0) + addition.target, 1
+                )
+                record("add", ticker=addition.ticker, added=added_ticker)
+        for rebalance in plan.rebalances:
+            targets[rebalance.ticker] = round(
+                targets.get(rebalance.ticker, 0) + rebalance.target, 1
+            )
+        self.apply_weights(targets)
+        for ticker, target in targets.items():
+            record("weight", ticker=ticker, target=target)
+        # an exact plan already adds up to 100%, unless some instruments couldn't be added
+        if not plan.exact or len(added) < len(plan.additions):
+            self.redistribute_pie()
+
+    @traced()
+    @retrying(on_retry=refresh_snapshot)
+    def apply_weights(self, targets):
+        # sets the target weights of multiple instruments, given as a dictionary of
+        # { [ticker]: [target] }, with a couple of script calls instead of typing
+        # each value in its field
+        slices = self.get_pie_snapshot()
+        changes = [
+            (slices[ticker], target)
+            for ticker, target in targets.items()
+            if ticker in slices and slices[ticker].weight != target
         ]
-
-    def rebalance_instrument(self, ticker, target, substitutions={}):
-        # round up to one decimal digit since that's the max decimal numbers
-        # theat the pie instrument spinner field support
-        target = round(float(target), 1)
-        if target < 0.5:
-            # skip allocations smaller than 0.5 as that's the minimum weight
-            # value supported by Trading212
-            log.warning(f"Ticker {ticker}'s target weight is less than 0.5, skipping...")
+        if not changes:
             return
 
-        try:
-            # check if the instrument container with the specified ticker exists
-            container = qX(
-                self.driver,
-                f"//div[@class='bucket-instrument-personalisation'"
-                f"and .//div[text()='{ticker}']]",
+        # the lock buttons as they were before typing the targets in
+        before = {instrument.ticker: instrument.lock for instrument, _ in changes}
+        fields = []
+        for instrument, target in changes:
+            log.info(f"Rebalacing {instrument.ticker}: {instrument.weight} → {target}")
+            field = qS(instrument.element, ".instrument-share-container .spinner input")
+            fields.append((field, target))
+        retyped = set_inputs(self.driver, fields)
+        if retyped:
+            log.debug(f"{len(retyped)} target fields had to be typed in manually")
+
+        # the instrument values usually get automatically locked as we do so, so
+        # unlock the ones that did to let them be redistributed afterwards. The
+        # lock buttons toggle, so the ones left unlocked mustn't be clicked: a
+        # slice counts as locked if it's marked as such, or if its lock button
+        # changed as its target was typed in (which is all the editor is relied on
+        # to do, however it shows the lock)
+        slices = self.get_pie_snapshot(refresh=True)
+        locked = [
+            slices[instrument.ticker]
+            for instrument, _ in changes
+            if instrument.ticker in slices
+            and (
+                slices[instrument.ticker].locked
+                or slices[instrument.ticker].lock != before[instrument.ticker]
             )
-        except:
-            # if not, add the instrument and attempt the re-balancing again
-            # once the instrument has been added
-            added_ticker = self.add_instrument(ticker, substitutions=substitutions)
-            if added_ticker:
-                self.rebalance_instrument(added_ticker, target)
+        ]
+        if locked:
+            self.driver.execute_script(
+                UNLOCK_SCRIPT, [instrument.element for instrument in locked]
+            )
+        # once unlocked, the buttons are back to how they were before typing
+        for instrument in locked:
+            slices[instrument.ticker] = instrument._replace(
+                locked=False, lock=before[instrument.ticker]
+            )
+
+    @traced()
+    def add_instrument(self, ticker, substitutions={}):
+        # adds a single instrument to the pie, returning the ticker it was added with
+        # (which might be one of its substitutions), or False if it wasn't added
+        return self.add_instruments([ticker], substitutions).get(ticker, False)
+
+    def find_instrument(self, search, timeout=SEARCH_TIMEOUT):
+        # returns the [data-qa-code] of the instrument being searched for, raising
+        # a TimeoutException if it's not found. With the network captured, the
+        # search results are read as soon as they are received, so a missing
+        # instrument doesn't have to wait for the whole timeout
+        ticker = search.ticker.upper()
+        if self.capture_network:
+            try:
+                results = self.api_response("search", timeout=timeout, query=f"({ticker})")
+                if not all("ticker" in result for result in results):
+                    raise ValueError("Unexpected search results format")
+                codes = {result["ticker"]: result["code"] for result in results}
+            except (TimeoutException, ValueError, KeyError, TypeError) as e:
+                log.debug(f"Search results not captured, reading the page: {e}")
+            else:
+                # only the search results actually received tell it's missing
+                if ticker in codes:
+                    return codes[ticker]
+                raise TimeoutException(f"Instrument {ticker} not in the search results")
+        # wait until the desired ticker is found in the search window,
+        # this will return the Trading212 [data-qa-code] attrigute for it
+        return search.wait(self.driver, timeout=timeout)
+
+    @traced()
+    def open_search_tab(self, url):
+        # opens the app in a new tab and gets to the instruments search popup by
+        # starting the creation of a new pie, which is then never completed.
+        # Returns the handle of the tab and its search field
+        handles = set(self.driver.window_handles)
+        self.driver.execute_script("window.open('about:blank', '_blank')")
+        handle = (set(self.driver.window_handles) - handles).pop()
+        self.driver.switch_to.window(handle)
+        # resources are blocked per tab, so it has to be done before loading the app
+        if getattr(self.driver, "lean", False):
+            self.driver.block_resources()
+        self.driver.get(url)
+        wait_for_not(self.driver, "#platform-loader")
+        wclick(self.driver, ".main-tabs div.portfolio-icon")
+        wait_for(self.driver, ".portfolio-section .investments-section")
+        wclick(self.driver, ".investments-section div[data-qa-tab=buckets]")
+        wclick(self.driver, ".buckets-list .bucket-creation-button")
+        wclick(self.driver, ".bucket-creation .add-instruments .button")
+        return handle, wqS(self.driver, ".bucket-add-slices input.search-input")
+
+    @traced()
+    def lookup_instruments(
+        self,
+        tickers,
+        substitutions={},
+        timeout=SEARCH_TIMEOUT,
+        poll=0.1,
+        min_batch=None,
+    ):
+        # finds the [data-qa-code] of a batch of instruments before the pie is
+        # edited, searching for several of them at once in separate tabs of the
+        # same session. The outcome of each search goes to the resolver, so adding
+        # the instruments only has to click on codes that are already known.
+        # Only the tickers without a cached search outcome are looked up
+        pending = []
+        for ticker in tickers:
+            candidates = self.resolver.candidates(ticker, substitutions)
+            if candidates and self.resolver.code(candidates[0]) is None:
+                pending.append(candidates)
+        # every tab loads the whole app, and found instruments are still searched
+        # for once more in the pie editor, so the tabs only pay off by not waiting
+        # for the misses one after another in batches of a few searches per tab
+        if min_batch is None:
+            min_batch = 2 * self.lookup_tabs
+        if not self.lookup_tabs or len(pending) < min_batch:
             return
 
-        # set the rebalanced value on the instrument's target input field
-        field = qS(container, ".instrument-share-container .spinner input")
-        previous_value = float(field.get_attribute("value"))
-        if previous_value != target:
-            log.info(f"Rebalacing {ticker}: {previous_value} → {target}")
-            send_input(field, target)
-            # the instrument value gets automatically locked as we do so,
-            # click the unlock button to let the instrument be redistributed afterwards
-            instrument_lock = qS(container, ".lock-unlock-tooltip")
-            instrument_lock.click()
-
-    def add_instrument(self, ticker, current_instruments_num=None, substitutions={}):
-        # get the amount of current instruments
-        if not current_instruments_num:
-            current_instruments_num = len(self.get_current_instruments_tickers())
+        main_handle = self.driver.current_window_handle
+        handles = set(self.driver.window_handles)
+        url = self.driver.current_url
+        tabs = []
+        # the search running in each tab, as [candidates left, search, started at]
+        searches = {}
+        try:
+            for _ in range(min(self.lookup_tabs, len(pending))):
+                tabs.append(self.open_search_tab(url))
+            log.info(f"Looking up {len(pending)} instruments in {len(tabs)} tabs")
+            while pending or searches:
+                for handle, search_field in tabs:
+                    search = searches.get(handle)
+                    if search is None:
+                        if not pending:
+                            continue
+                        search = searches[handle] = [pending.pop(0), None, 0]
+                    self.driver.switch_to.window(handle)
+                    candidates, lookup, started = search
+                    if lookup is None:
+                        # type the next candidate of the instrument in the search field
+                        search[1] = TickerFoundInInstrumentSearch(
+                            search_field, candidates[0]
+                        )
+                        search[2] = time.perf_counter()
+                        continue
+                    code = lookup.check(self.driver)
+                    # like wait_until, a learned timeout shorter than the default
+                    # one doesn't make a miss, and a search found after it
+                    # expired gives the next searches more time
+                    elapsed = time.perf_counter() - started
+                    learned = latencies.timeout("search", timeout)
+                    if code:
+                        latencies.observe("search", elapsed)
+                        if elapsed > learned:
+                            latencies.expire("search")
+                        self.resolver.record(candidates[0], found=True, code=code)
+                        del searches[handle]
+                    elif elapsed > max(learned, timeout):
+                        latencies.expire("search", expected=True)
+                        log.debug(f"Instrument {candidates[0]} not found")
+                        self.resolver.record(candidates[0], found=False)
+                        candidates.pop(0)
+                        if candidates:
+                            search[1] = None
+                        else:
+                            del searches[handle]
+                time.sleep(poll)
+        finally:
+            # close all the tabs opened here, including one that failed to load
+            for handle in set(self.driver.window_handles) - handles:
+                self.driver.switch_to.window(handle)
+                self.driver.close()
+            self.driver.switch_to.window(main_handle)
+            self.resolver.save()
+
+    @traced()
+    def add_instruments(self, tickers, substitutions={}):
+        # adds a list of instruments to the pie in a single session of the search
+        # popup, returning a dictionary of { [ticker]: [ticker it was added with] }
+        current_instruments_num = len(self.get_current_instruments_tickers())
+        if not tickers:
+            return {}
 
         try:
             # is the 'add slices to pie' popup already open? (happens on pie creation)
@@ -307,59 +706,96 @@ class Navigator:
         search_field = wqS(self.driver, ".bucket-add-slices input.search-input")
         confirm_button = wqS(self.driver, ".bucket-add-slices-footer > .button")
 
-        # if we reached the maximum amount of instruments in the pie,
-        # we can't add more instruments - call it a day and go home
-        if current_instruments_num == 50:
-            log.error(
-                f"Can't add {ticker} - maximum amount of instruments in pie reached"
-            )
-            confirm_button.click()
-            return False
+        added = {}
+        for ticker in tickers:
+            # if we reached the maximum amount of instruments in the pie,
+            # we can't add more instruments - call it a day and go home
+            if current_instruments_num + len(added) >= 50:
+                log.error(
+                    f"Can't add {ticker} - maximum amount of instruments in pie reached"
+                )
+                break
 
-        try:
-            # wait until the desired ticker is found in the search window, this will
-            # return the Trading212 [data-qa-code] attrigute for that instrument
-            instrument_code = WebDriverWait(self.driver, 2).until(
-                TickerFoundInInstrumentSearch(search_field, ticker)
-            )
-        except TimeoutException:
-            log.error(f"Instrument {ticker} not found!")
-            if ticker in substitutions:
-                # if the ticker was not found, see if we defined any replacement tickers
-                # for it and re-attempt the adding process
-                old_ticker = ticker
-                ticker = substitutions[old_ticker]
-                log.debug(f"Re-trying with ticker {old_ticker} substitution {ticker}")
-                return self.add_instrument(ticker, current_instruments_num, substitutions)
+            for candidate in self.resolver.candidates(ticker, substitutions):
+                if candidate in added.values():
+                    # already selected (e.g. the same substitution for two tickers)
+                    added[ticker] = candidate
+                    break
+                self.clear_responses()
+                search = TickerFoundInInstrumentSearch(search_field, candidate)
+                instrument_code = self.resolver.code(candidate)
+                try:
+                    if instrument_code:
+                        # the code is already known from a lookup, so only wait
+                        # for its search result to show up
+                        wait_for(
+                            self.driver,
+                            f"[data-qa-code='{instrument_code}']",
+                            timeout=5,
+                            operation="search result",
+                        )
+                    else:
+                        instrument_code = self.find_instrument(search)
+                except TimeoutException:
+                    log.error(f"Instrument {candidate} not found!")
+                    self.resolver.record(candidate, found=False)
+                    continue
+                self.resolver.record(candidate, found=True, code=instrument_code)
+
+                # select the instrument search result by using the [[data-qa-code]
+                # attribute and add it to the list. The results are re-rendered as
+                # the search updates, so the button is looked up again if it goes stale
+                wclick(
+                    self.driver,
+                    f"[data-qa-code='{instrument_code}'] .add-to-bucket",
+                    operation="add to pie button",
+                )
+                log.info(f"Adding instrument {candidate}")
+                added[ticker] = candidate
+                break
             else:
-                # if not, don't add any instruments and close the search window
-                confirm_button.click()
-                return False
-
-        # select the instrument search result by using the [[data-qa-code] attribute
-        # and add it to the list
-        # TODO: Once in a blue moon this triggers a StaleElementException
-        wqS(self.driver, f"[data-qa-code='{instrument_code}'] .add-to-bucket").click()
-        confirm_button.click()
-
-        log.info(f"Adding instrument {ticker}")
+                suggestions = self.resolver.suggest(ticker)
+                if suggestions:
+                    log.warning(
+                        f"No instrument found for {ticker}, "
+                        f"similar ones: {', '.join(suggestions)}"
+                    )
 
-        # wait until the amount of current instruments reflects the addition
-        WebDriverWait(self.driver, 10).until(
-            lambda d: len(self.get_current_instruments_tickers())
-            == current_instruments_num + 1
+        # confirm all the selected instruments at once, or just close the search window
+        confirm_button.click()
+        if not added:
+            self.resolver.save()
+            return added
+
+        # wait until the amount of current instruments reflects the additions
+        expected_instruments_num = current_instruments_num + len(set(added.values()))
+        wait_for_count(
+            self.driver, ".bucket-instrument-personalisation", expected_instruments_num
         )
-        return ticker
 
+        # then verify the final set of instruments with a single snapshot
+        slices = self.get_pie_snapshot(refresh=True)
+        for ticker, added_ticker in list(added.items()):
+            if added_ticker not in slices:
+                log.error(f"Instrument {added_ticker} was not added to the pie!")
+                del added[ticker]
+            else:
+                self.resolver.record_resolution(ticker, added_ticker)
+        self.resolver.save()
+        return added
+
+    @traced()
+    @retrying(on_retry=refresh_snapshot)
     def remove_instrument(self, ticker):
         # get the amount of current instruments
-        current_instruments_num = len(self.get_current_instruments_tickers())
+        slices = self.get_pie_snapshot()
+        current_instruments_num = len(slices)
+        if ticker not in slices:
+            # already removed by a previous attempt
+            return
 
         # get the instrument container with the specified ticker to delete
-        container = qX(
-            self.driver,
-            f"//div[@class='bucket-instrument-personalisation' and .//div[text()='{ticker}']]",
-        )
+        container = slices[ticker].element
 
         # click the delete button and confirm deletion on the popup
         qS(container, ".close-button").click()
@@ -368,13 +804,14 @@ class Navigator:
         qS(self.driver, ".popup-content .dialog .confirm-button").click()
 
         # wait until the amount of current instruments reflects the deletion
-        WebDriverWait(self.driver, 10).until(
-            lambda d: len(self.get_current_instruments_tickers())
-            == current_instruments_num - 1
+        wait_for_count(
+            self.driver, ".bucket-instrument-personalisation", current_instruments_num - 1
         )
+        del slices[ticker]
 
+    @traced()
     def get_available_instruments(self):
-        self.driver.get("https://www.trading212.com/en/Trade-Equities")
+        self.driver.get(f"{self.base_url}/en/Trade-Equities")
         wait_for(self.driver, "#all-equities")
         # cells = qSS(self.driver, "#all-equities [data-label='Instrument']")
         # instruments = [cell.get_attribute("textContent") for cell in cells]
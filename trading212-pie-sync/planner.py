@@ -0,0 +1,105 @@
+import logging
+from collections import namedtuple
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# Trading212 pies limits: allocations are expressed with one decimal digit,
+# can't go under 0.5% and a pie can't hold more than 50 instruments
+MIN_WEIGHT = 0.5
+MAX_INSTRUMENTS = 50
+
+# the operations that make up a sync plan
+Removal = namedtuple("Removal", ["ticker"])
+Addition = namedtuple("Addition", ["ticker", "target"])
+Rebalance = namedtuple("Rebalance", ["ticker", "previous", "target"])
+
+
+class SyncPlan:
+    def __init__(self, removals=None, additions=None, rebalances=None, skipped=None):
+        self.removals = removals or []
+        self.additions = additions or []
+        self.rebalances = rebalances or []
+        # source tickers that were left out of the plan (e.g. under the minimum weight)
+        self.skipped = skipped or []
+        # whether the planned targets add up to exactly 100%, in which case the pie
+        # won't need redistributing once they are all set
+        self.exact = False
+
+    def __len__(self):
+        return len(self.removals) + len(self.additions) + len(self.rebalances)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def describe(self):
+        # returns a human readable list of lines describing every operation,
+        # used to print the plan when doing a dry run
+        lines = [f"- {removal.ticker}" for removal in self.removals]
+        lines += [f"+ {addition.ticker}: {addition.target}" for addition in self.additions]
+        lines += [
+            f"~ {rebalance.ticker}: {rebalance.previous} → {rebalance.target}"
+            for rebalance in self.rebalances
+        ]
+        lines += [f"! {ticker}: skipped" for ticker in self.skipped]
+        return lines
+
+
+def normalize_target(target):
+    # round up to one decimal digit since that's the max decimal numbers
+    # that the pie instrument spinner field support
+    return round(float(target), 1)
+
+
+def normalize_holdings(holdings):
+    # the holdings allocation as it would be applied to a pie, with rounded targets
+    # and without the ones under the minimum weight
+    targets = {ticker: normalize_target(target) for ticker, target in holdings.items()}
+    return {ticker: target for ticker, target in targets.items() if target >= MIN_WEIGHT}
+
+
+def substitutes(substitutions, ticker):
+    # the ordered list of replacements for a ticker, as substitutions can map
+    # a ticker either to a single replacement or to a list of candidates
+    replacements = substitutions.get(ticker) or []
+    if isinstance(replacements, str):
+        return [replacements]
+    return list(replacements)
+
+
+def plan_sync(current, source, substitutions={}):
+    # computes the minimal set of edits to turn the current pie, a dictionary of
+    # { [ticker]: [current weight] }, into the source holdings allocation,
+    # { [ticker]: [target weight] }, dropping every operation that is a no-op
+    plan = SyncPlan()
+
+    targets = {}
+    for ticker, target in source.items():
+        target = normalize_target(target)
+        if target < MIN_WEIGHT:
+            # skip allocations smaller than 0.5 as that's the minimum weight
+            # value supported by Trading212
+            log.warning(f"Ticker {ticker}'s target weight is less than 0.5, skipping...")
+            plan.skipped.append(ticker)
+            continue
+        # if the source ticker isn't in the pie but one of its substitutions is, the
+        # substitution was added by a previous sync, so rebalance that one instead
+        if ticker not in current:
+            for substitute in substitutes(substitutions, ticker):
+                if substitute in current:
+                    ticker = substitute
+                    break
+        targets[ticker] = targets.get(ticker, 0.0) + target
+
+    plan.exact = round(sum(targets.values()) * 10) == 1000
+    for ticker in current:
+        if ticker not in targets:
+            plan.removals.append(Removal(ticker))
+
+    for ticker, target in targets.items():
+        target = normalize_target(target)
+        if ticker not in current:
+            plan.additions.append(Addition(ticker, target))
+        elif normalize_target(current[ticker]) != target:
+            plan.rebalances.append(Rebalance(ticker, current[ticker], target))
+
+    return plan
@@ -0,0 +1,160 @@
+import difflib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from catalog import ticker_variants
+from planner import substitutes
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+def normalized_tickers(ticker):
+    # the forms a ticker could be searched with: the catalog variants (0700.HK →
+    # 0700 → 700), followed by the zero-padded form of numeric ones (700 → 0700),
+    # which is how exchanges like the HKEX list them
+    variants = ticker_variants(ticker)
+    base = variants[-1]
+    if base.isdigit() and len(base) < 4:
+        padded = base.zfill(4)
+        if padded not in variants:
+            variants.append(padded)
+    return variants
+
+
+class TickerResolver:
+    # Works out which ticker to search for when adding an instrument to a pie,
+    # remembering the outcome of every search so that tickers known to be missing
+    # aren't searched for again until the cache expires. Without a path, the
+    # cache is only kept in memory
+    def __init__(self, path=None, catalog=None, ttl=7 * 24 * 60 * 60):
+        self.path = Path(path) if path else None
+        self.catalog = catalog
+        self.ttl = ttl
+        # { [searched ticker]: { "found": bool, "code": [data-qa-code] of the
+        # search result, "checked_at": timestamp } }
+        self.lookups = {}
+        # { [source ticker]: { "ticker": resolved ticker, "resolved_at": timestamp } }
+        self.resolved = {}
+        # the resolver can be shared across the workers syncing a manifest
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return False
+        try:
+            data = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            return False
+        self.lookups = data.get("lookups", {})
+        self.resolved = data.get("resolved", {})
+        return True
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            lookups = {
+                ticker: lookup
+                for ticker, lookup in self.lookups.items()
+                if lookup.get("conclusive", True)
+            }
+            data = {"lookups": lookups, "resolved": self.resolved}
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(data, indent=2))
+
+    def _fresh(self, timestamp):
+        return time.time() - timestamp <= self.ttl
+
+    def is_known_missing(self, ticker):
+        # inconclusive misses don't count, so they're searched for again even by
+        # a long-lived resolver (e.g. the one of the daemon)
+        lookup = self.lookups.get(ticker)
+        return (
+            bool(lookup)
+            and not lookup["found"]
+            and lookup.get("conclusive", True)
+            and self._fresh(lookup["checked_at"])
+        )
+
+    def code(self, ticker):
+        # the [data-qa-code] a ticker was found with by a recent search, if any
+        lookup = self.lookups.get(ticker)
+        if lookup and lookup["found"] and self._fresh(lookup["checked_at"]):
+            return lookup.get("code")
+        return None
+
+    def resolution(self, ticker):
+        # the ticker a source ticker was last added to a pie with, if still fresh
+        entry = self.resolved.get(ticker)
+        if entry and self._fresh(entry["resolved_at"]):
+            return entry["ticker"]
+        return None
+
+    def record(self, ticker, found, code=None, conclusive=True):
+        # inconclusive outcomes (e.g. a search which might have been cut short)
+        # are only kept for this run, and not saved to the cache
+        with self.lock:
+            self.lookups[ticker] = {
+                "found": found,
+                "code": code,
+                "checked_at": time.time(),
+            }
+            if not conclusive:
+                self.lookups[ticker]["conclusive"] = False
+
+    def record_resolution(self, ticker, resolved):
+        with self.lock:
+            self.resolved[ticker] = {"ticker": resolved, "resolved_at": time.time()}
+
+    def candidates(self, ticker, substitutions={}):
+        # returns the tickers to search for, in order: the last resolution of the
+        # ticker, then the ticker itself and its substitutions (and theirs, in
+        # turn), each followed by its normalized forms. When a catalog is available
+        # only the listed instruments are kept, and known missing ones are dropped
+        names = [ticker]
+        for name in names:
+            for substitute in substitutes(substitutions, name):
+                if substitute not in names:
+                    names.append(substitute)
+
+        candidates = []
+        resolved = self.resolution(ticker)
+        if resolved:
+            candidates.append(resolved)
+        for name in names:
+            for variant in normalized_tickers(name):
+                if self.catalog:
+                    variant = self.catalog.lookup(variant)
+                if variant and variant not in candidates:
+                    candidates.append(variant)
+
+        known_missing = [c for c in candidates if self.is_known_missing(c)]
+        if known_missing:
+            log.debug(f"Skipping {', '.join(known_missing)}, not found by a recent search")
+        candidates = [c for c in candidates if c not in known_missing]
+        if not candidates:
+            log.error(f"Instrument {ticker} not available on Trading212!")
+        return candidates
+
+    def suggest(self, ticker, limit=3):
+        # close matches of the ticker among the instruments of the catalog,
+        # to help picking a substitution for it
+        if not self.catalog:
+            return []
+        return difflib.get_close_matches(
+            ticker.strip().upper(), self.catalog.instruments, n=limit, cutoff=0.75
+        )
+
+    def aliases(self, substitutions={}):
+        # the substitutions extended with the tickers source tickers were last
+        # resolved to, so the planner can recognize them when already in a pie
+        aliases = {ticker: substitutes(substitutions, ticker) for ticker in substitutions}
+        for ticker in self.resolved:
+            resolved = self.resolution(ticker)
+            if resolved and resolved != ticker:
+                aliases[ticker] = [resolved] + aliases.get(ticker, [])
+        return aliases
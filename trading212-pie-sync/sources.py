@@ -0,0 +1,113 @@
+import csv
+import gzip
+import heapq
+import io
+import json
+import logging
+import math
+from pathlib import Path
+
+from planner import MAX_INSTRUMENTS, substitutes
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+def open_source(path):
+    # opens a holdings file as text, transparently decompressing gzipped ones
+    path = Path(path)
+    if path.suffix == ".gz":
+        return io.TextIOWrapper(gzip.open(path), encoding="utf-8", newline="")
+    return path.open(encoding="utf-8", newline="")
+
+
+def source_format(path):
+    # the format of a holdings file from its extension, ignoring the .gz one
+    suffixes = [suffix.lower() for suffix in Path(path).suffixes if suffix != ".gz"]
+    suffix = suffixes[-1] if suffixes else ""
+    if suffix in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if suffix == ".json":
+        return "json"
+    return "csv"
+
+
+def parse_weight(value):
+    # returns the weight as a float, or None if the value isn't a weight
+    # (e.g. the header row of a csv file, or "inf" and "nan")
+    try:
+        weight = float(str(value).strip().rstrip("%"))
+    except ValueError:
+        return None
+    return weight if math.isfinite(weight) else None
+
+
+def parse_entry(entry):
+    # yields the (ticker, weight) pairs of an entry of a json or json-lines file,
+    # either an object of { [ticker]: [weight] }, an object with "ticker" and
+    # "weight" keys, or a [ticker, weight] pair
+    if isinstance(entry, dict):
+        if "ticker" in entry:
+            yield entry["ticker"], entry.get("weight", entry.get("percentage"))
+        else:
+            yield from entry.items()
+    elif isinstance(entry, (list, tuple)) and len(entry) >= 2:
+        yield entry[0], entry[1]
+
+
+def iter_rows(file, format):
+    # lazily yields the raw (ticker, weight) rows of a holdings file
+    if format == "csv":
+        for row in csv.reader(file):
+            if len(row) >= 2:
+                yield row[0], row[1]
+    elif format == "jsonl":
+        for line in file:
+            if line.strip():
+                yield from parse_entry(json.loads(line))
+    else:
+        data = json.load(file)
+        for entry in data if isinstance(data, list) else [data]:
+            yield from parse_entry(entry)
+
+
+def read_holdings(
+    path, substitutions={}, catalog=None, limit=MAX_INSTRUMENTS, format=None
+):
+    # streams the holdings from a .csv, .json or .jsonl file (optionally gzipped),
+    # summing the weights of duplicate tickers, and returns only the top holdings
+    # as a dictionary of { [ticker]: [weight] }. When an instruments catalog is
+    # available, tickers not on Trading212 are replaced by their first listed
+    # substitution
+    format = format or source_format(path)
+    with open_source(path) as file:
+        return collect_holdings(
+            iter_rows(file, format), substitutions, catalog, limit, origin=path
+        )
+
+
+def collect_holdings(
+    rows, substitutions={}, catalog=None, limit=MAX_INSTRUMENTS, origin="holdings"
+):
+    # validates raw (ticker, weight) rows from any source into the top holdings,
+    # as a dictionary of { [ticker]: [weight] }, the same way holdings files are
+    weights = {}
+    skipped = 0
+    for ticker, weight in rows:
+        ticker = str(ticker).strip().upper()
+        weight = parse_weight(weight)
+        if not ticker or weight is None or weight <= 0:
+            skipped += 1
+            continue
+        # an empty catalog (not fetched yet) can't tell what's not available
+        if catalog and ticker not in catalog:
+            listed = [s for s in substitutes(substitutions, ticker) if s in catalog]
+            ticker = listed[0] if listed else ticker
+        weights[ticker] = weights.get(ticker, 0.0) + weight
+    if skipped:
+        log.debug(f"Skipped {skipped} rows of {origin} without a valid holding")
+
+    # only keep the largest holdings, as a pie can't hold more than that anyway
+    if limit and len(weights) > limit:
+        log.info(f"Keeping the top {limit} of {len(weights)} holdings from {origin}")
+        return dict(heapq.nlargest(limit, weights.items(), key=lambda h: h[1]))
+    return weights
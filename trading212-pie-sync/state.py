@@ -0,0 +1,83 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from allocation import solve_allocation
+from planner import normalize_holdings, substitutes
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+
+def applied_allocation(holdings):
+    # the targets a pie actually gets when synced with the holdings, which are
+    # rescaled to add up to 100%, so that weights too small to make it to the pie
+    # as they are still count if they end up in it
+    return normalize_holdings(solve_allocation(holdings))
+
+
+def fingerprint(holdings, substitutions={}):
+    # a content hash of a holdings allocation as it would be applied to a pie,
+    # which doesn't depend on the order of the tickers or on how they're formatted.
+    # The substitutions of its tickers are part of it, as they change which
+    # instruments end up in the pie
+    allocation = applied_allocation(holdings)
+    normalized = sorted(allocation.items())
+    replacements = sorted(
+        (ticker, substitutes(substitutions, ticker))
+        for ticker in allocation
+        if substitutes(substitutions, ticker)
+    )
+    if replacements:
+        normalized = [normalized, replacements]
+    return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+
+def account_key(username):
+    # the account is only stored as a hash, to keep emails out of the state file
+    return hashlib.sha256(username.strip().lower().encode()).hexdigest()[:16]
+
+
+class SyncState:
+    # A small local store remembering the allocation last applied to each pie,
+    # so that syncs with an unchanged source can be skipped without a browser
+    def __init__(self, path=None):
+        self.path = Path(path or Path.cwd() / "state" / "pies.json")
+        try:
+            self.entries = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.entries = {}
+        # the store can be shared across the workers syncing a manifest
+        self.lock = threading.Lock()
+
+    def _key(self, account, pie):
+        return f"{account_key(account)}/{pie}"
+
+    def get(self, account, pie):
+        return self.entries.get(self._key(account, pie))
+
+    def is_unchanged(self, account, pie, holdings, max_age=None, substitutions={}):
+        # true if the holdings (and their substitutions) match the allocation last
+        # applied to the pie, and it was applied no longer than max_age seconds ago
+        entry = self.get(account, pie)
+        if entry is None or entry["fingerprint"] != fingerprint(
+            holdings, substitutions
+        ):
+            return False
+        if max_age is not None and time.time() - entry["applied_at"] > max_age:
+            log.debug(f"Last sync of pie {pie} is older than {max_age}s")
+            return False
+        return True
+
+    def record(self, account, pie, holdings, source=None, substitutions={}):
+        with self.lock:
+            self.entries[self._key(account, pie)] = {
+                "allocation": applied_allocation(holdings),
+                "fingerprint": fingerprint(holdings, substitutions),
+                "source": source,
+                "applied_at": time.time(),
+            }
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(self.entries, indent=2))
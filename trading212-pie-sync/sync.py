@@ -0,0 +1,121 @@
+import json
+import logging
+
+from allocation import solve_allocation
+from planner import SyncPlan, plan_sync
+from sources import read_holdings
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# how many times a sync interrupted by the page changing under it is resumed,
+# before giving up
+RESUME_ATTEMPTS = 2
+
+
+def load_source(
+    navigator,
+    from_json=None,
+    from_csv=None,
+    from_shared_pie=None,
+    substitutions={},
+    catalog=None,
+):
+    # parses the holdings to sync from one of the supported sources,
+    # returning a dictionary of { [ticker]: [percentage] }
+    data = {}
+    if from_json:
+        data = read_holdings(from_json, substitutions, catalog)
+    elif from_csv:
+        data = read_holdings(from_csv, substitutions, catalog, format="csv")
+    elif from_shared_pie:
+        data = navigator.parse_shared_pie(from_shared_pie)
+    return data
+
+
+def load_substitutions(file):
+    return json.load(file) if file else {}
+
+
+def sync_pie(
+    navigator,
+    pie,
+    data,
+    substitutions={},
+    dry_run=False,
+    await_confirm=False,
+    journal=None,
+):
+    # syncs the pie with the given holdings on an already logged in navigator,
+    # returning the plan of changes that has been applied. Selenium is only
+    # imported here, so that planning doesn't need it
+    from driver import RESUMABLE_ERRORS
+
+    # work out the exact targets the pie can hold, so it doesn't need redistributing
+    data = solve_allocation(data)
+
+    # if a previous sync of the same holdings was interrupted, check how far it went
+    if journal is not None and not dry_run:
+        done = journal.resume(data)
+        if any(entry["op"] == "commit" for entry in done):
+            log.info(f"[{pie}] Changes already committed by the interrupted sync")
+            return SyncPlan()
+        if done:
+            # edits are only saved when committed, so the interrupted ones are lost
+            # and the plan is worked out again from the pie as it is now
+            log.info(
+                f"[{pie}] Resuming an interrupted sync, "
+                f"{len(done)} uncommitted operations have to be done again"
+            )
+
+    navigator.select_pie(pie)
+
+    # take a single snapshot of the pie and work out the minimal set of edits
+    # needed to sync it, so the browser only touches what actually changes
+    aliases = navigator.resolver.aliases(substitutions)
+    plan = plan_sync(navigator.get_current_instruments(), data, aliases)
+    for line in plan.describe():
+        log.info(f"[{pie}] {line}")
+    if dry_run:
+        log.info(f"Dry run: {len(plan)} changes planned, nothing was applied")
+        return plan
+
+    for attempt in range(RESUME_ATTEMPTS + 1):
+        try:
+            navigator.apply_plan(plan, substitutions, journal)
+            break
+        except RESUMABLE_ERRORS as e:
+            if attempt == RESUME_ATTEMPTS:
+                raise
+            # start again from a clean editor and a fresh snapshot of the pie,
+            # without logging in again or repeating the instrument lookups
+            log.warning(f"[{pie}] Sync interrupted ({type(e).__name__}), resuming")
+            if journal is not None:
+                journal.record("reload")
+            navigator.reload_app()
+            navigator.select_pie(pie)
+            plan = plan_sync(navigator.get_current_instruments(), data, aliases)
+
+    if not await_confirm:
+        navigator.commit_pie_edits(name=pie)
+        if journal is not None:
+            journal.record("commit")
+    else:
+        input("Confirm changes and then press Enter to close the browser...")
+    return plan
+
+
+def sync_backend(backend, pie, data, substitutions={}, dry_run=False):
+    # syncs the pie with the given holdings through a logged in backend, which
+    # reads the pie and saves all the changes at once, returning the applied plan
+    data = solve_allocation(data)
+    resolver = getattr(backend, "resolver", None)
+    aliases = resolver.aliases(substitutions) if resolver else substitutions
+    plan = plan_sync(backend.read_pie(pie), data, aliases)
+    for line in plan.describe():
+        log.info(f"[{pie}] {line}")
+    if dry_run:
+        log.info(f"Dry run: {len(plan)} changes planned, nothing was applied")
+        return plan
+    if plan:
+        backend.apply_plan(pie, plan, substitutions)
+    return plan
@@ -0,0 +1,195 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from latency import latencies
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# the category of spans spent waiting for the website, rather than working
+WAIT = "wait"
+
+
+class Tracer:
+    # Records timed spans of the sync process along with the WebDriver commands
+    # issued during each of them. Disabled by default, in which case tracing
+    # a span costs next to nothing
+    def __init__(self):
+        self.enabled = False
+        self.export_path = None
+        self.spans = []
+        self.commands = Counter()
+        self.started = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def enable(self, export_path=None):
+        self.enabled = True
+        self.export_path = export_path
+        self.started = time.perf_counter()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+            self._local.commands = 0
+        return self._local.stack
+
+    def count_command(self, command):
+        if self.enabled:
+            self._stack()
+            self._local.commands += 1
+            with self._lock:
+                self.commands[command] += 1
+
+    @contextmanager
+    def span(self, name, category="work"):
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        # a wait nested in another wait (e.g. wqS calling wait_until) is only
+        # counted once towards the time spent waiting
+        nested_wait = any(parent == WAIT for parent in stack)
+        stack.append(category)
+        commands = self._local.commands
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stack.pop()
+            span = {
+                "name": name,
+                "category": category,
+                "start": started - self.started,
+                "duration": time.perf_counter() - started,
+                "commands": self._local.commands - commands,
+                "thread": threading.get_ident(),
+                "depth": len(stack),
+                "waiting": category == WAIT and not nested_wait,
+            }
+            with self._lock:
+                self.spans.append(span)
+
+    def summary(self):
+        # aggregates the spans by name, slowest first
+        rows = {}
+        for span in self.spans:
+            row = rows.setdefault(
+                span["name"],
+                {"name": span["name"], "category": span["category"], "calls": 0},
+            )
+            row["calls"] += 1
+            row["seconds"] = row.get("seconds", 0) + span["duration"]
+            row["commands"] = row.get("commands", 0) + span["commands"]
+        return sorted(rows.values(), key=lambda row: row["seconds"], reverse=True)
+
+    def totals(self):
+        elapsed = time.perf_counter() - self.started
+        waiting = sum(span["duration"] for span in self.spans if span["waiting"])
+        return {
+            "seconds": elapsed,
+            "waiting": waiting,
+            "working": max(elapsed - waiting, 0),
+            "commands": sum(self.commands.values()),
+        }
+
+    def export(self, path):
+        # saves the spans in the chrome trace event format, which can be opened in
+        # chrome://tracing or https://ui.perfetto.dev, along with the run summary
+        events = [
+            {
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": round(span["start"] * 1e6),
+                "dur": round(span["duration"] * 1e6),
+                "pid": os.getpid(),
+                "tid": span["thread"],
+                "args": {"commands": span["commands"]},
+            }
+            for span in self.spans
+        ]
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "traceEvents": events,
+                    "summary": self.summary(),
+                    "totals": self.totals(),
+                    "commands": dict(self.commands),
+                    "latencies": latencies.summary(),
+                    "timestamp": time.time(),
+                },
+                file,
+            )
+        log.info(f"Exported {len(events)} trace events to {path}")
+
+    def report(self):
+        # prints the run summary table, and exports the trace if requested
+        if not self.enabled:
+            return
+        from rich.console import Console
+        from rich.table import Table
+
+        totals = self.totals()
+        table = Table(
+            title=f"Run summary: {totals['seconds']:.1f}s, "
+            f"{totals['waiting']:.1f}s waiting, {totals['working']:.1f}s working, "
+            f"{totals['commands']} WebDriver commands"
+        )
+        for column in ("Span", "Category", "Calls", "Time", "Commands"):
+            table.add_column(column)
+        for row in self.summary():
+            table.add_row(
+                row["name"],
+                row["category"],
+                str(row["calls"]),
+                f"{row['seconds']:.2f}s",
+                str(row["commands"]),
+            )
+        Console().print(table)
+
+        # the latencies the timeouts of this run's waits were learned from
+        rows = latencies.summary()
+        if rows:
+            table = Table(title="Wait latencies")
+            columns = ("Operation", "Samples", "p50", "p95", "p99", "Timeout", "Expired")
+            for column in columns:
+                table.add_column(column)
+            for row in rows:
+                table.add_row(
+                    row["operation"],
+                    f"{row['samples']:.0f}",
+                    *(
+                        f"{row[key]:.2f}s" if row[key] is not None else "-"
+                        for key in ("p50", "p95", "p99", "timeout")
+                    ),
+                    str(row["expired"]),
+                )
+            Console().print(table)
+        if self.export_path:
+            self.export(self.export_path)
+
+
+tracer = Tracer()
+
+
+def traced(name=None, category="work"):
+    # decorator recording each call of a function as a span of the global tracer
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.span(span_name, category):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,163 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+from sources import read_holdings
+
+log = logging.getLogger(f"trading-212-sync.{__name__}")
+
+# inotify events signalling that a file has been written, or replaced by another one
+# (e.g. written to a temporary file and then renamed over the watched one)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# the fixed size header of an inotify event: wd, mask, cookie and name length
+EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    # Waits for changes to a set of files with the linux inotify api, watching
+    # their directories so that files replaced by a rename are picked up too
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # the names of the watched files, by the watch descriptor of their directory
+        self.names = {}
+        paths = [Path(path).resolve() for path in paths]
+        for directory in {path.parent for path in paths}:
+            wd = libc.inotify_add_watch(self.fd, str(directory).encode(), WATCH_MASK)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"Can't watch {directory}")
+            self.names[wd] = {path.name for path in paths if path.parent == directory}
+
+    def wait(self, timeout=None):
+        # waits for one of the files to change, returning False if the timeout
+        # expires first
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            remaining = max(deadline - time.time(), 0) if deadline else None
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            data = os.read(self.fd, 64 * 1024)
+            changed = False
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0").decode()
+                offset += length
+                changed = changed or name in self.names.get(wd, ())
+            if changed:
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Waits for changes to a set of files by checking their modification time and
+    # size, for the platforms without inotify
+    def __init__(self, paths, interval=1.0):
+        self.paths = [Path(path) for path in paths]
+        self.interval = interval
+        self.signatures = self._signatures()
+
+    def _signatures(self):
+        signatures = []
+        for path in self.paths:
+            try:
+                stat = path.stat()
+                signatures.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signatures.append(None)
+        return signatures
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            signatures = self._signatures()
+            if signatures != self.signatures:
+                self.signatures = signatures
+                return True
+            if deadline and time.time() >= deadline:
+                return False
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+def open_watcher(paths):
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError) as e:
+        # AttributeError: the C library doesn't have the inotify functions
+        log.debug(f"inotify not available ({e}), polling the files for changes")
+        return PollingWatcher(paths)
+
+
+def changes(watcher, debounce=2.0):
+    # yields every time the watched files change, once a burst of writes has
+    # settled down for the debounce interval, in seconds
+    while True:
+        watcher.wait()
+        while watcher.wait(timeout=debounce):
+            pass
+        yield
+
+
+def watch_source(
+    daemon, pie, path, format=None, substitutions={}, catalog=None, debounce=2.0, **job
+):
+    # syncs the pie with a holdings file right away, and then again every time the
+    # file changes, on the daemon's browser session which is kept open in between.
+    # The daemon skips the syncs where the holdings match the ones last applied
+    watcher = open_watcher([path])
+
+    def sync():
+        try:
+            data = read_holdings(path, substitutions, catalog, format=format)
+        except (OSError, ValueError) as e:
+            log.error(f"Couldn't read the holdings from {path}: {e}")
+            return
+        if not data:
+            log.warning(f"No holdings in {path}, not syncing")
+            return
+        try:
+            result = daemon.run(
+                {
+                    "pie": pie,
+                    "holdings": data,
+                    "substitutions": substitutions,
+                    "source": str(path),
+                    **job,
+                }
+            )
+        except Exception as e:
+            # keep watching, the next change might sync fine
+            log.error(f"Failed to sync pie {pie}: {e}")
+            return
+        if not result.get("skipped"):
+            log.info(f"Synced pie {pie} with {len(result['changes'])} changes")
+
+    log.info(f"Watching {path} for changes")
+    try:
+        sync()
+        for _ in changes(watcher, debounce):
+            log.info(f"{path} changed")
+            sync()
+    finally:
+        watcher.close()
+        daemon.stop_session()